@@ -1,8 +1,30 @@
+from collections import deque
+
 from base_agent import BaseAgent
+from content import terms
+
+# Most owner submissions kept for the content filter; older ones are
+# forgotten first.
+MAX_DOCUMENTS = 1000
 
 class AgentStorer(BaseAgent):
     def __init__(self):
         super().__init__(name="AgentStorer")
         self.system_prompt = "I am an agent who stores information for a business owner, content creator, or any other person who wants to present information to world through Elmnet. They will provide the information to me and I will store it in a database and keep it organized. I will respond by letting the user know that I am notifying connected Elmnet nodes of the updated information provided"
+        # Information provided by the owner.  Its terms are advertised to
+        # peers so that they only route relevant queries to this node.
+        # Only owner requests reach this agent (peer queries take the
+        # orchestrator's external path).
+        self.documents = deque(maxlen=MAX_DOCUMENTS)
+
+    def handle_request(self, query: str):
+        self.documents.append(query)
+        return super().handle_request(query)
+
+    def content_terms(self):
+        found = set()
+        for document in list(self.documents):
+            found |= terms(document)
+        return found
 
 agent_storer = AgentStorer()
\ No newline at end of file
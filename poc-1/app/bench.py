@@ -0,0 +1,385 @@
+"""
+bench.py
+~~~~~~~~
+
+Micro benchmarks for the P2P networking layer.  Each benchmark is a
+sub command::
+
+    python app/bench.py codec
+    python app/bench.py stress --concurrency 500
+    python app/bench.py gossip --nodes 50 --fanouts 1,2,3,4,0
+    python app/bench.py writes --senders 1,10,100
+    python app/bench.py loops --nodes 10
+    python app/bench.py quorum --nodes 6
+
+The benchmarks only exercise :mod:`network` and its helpers; they do
+not need Ollama or the agents to be running.  Nodes are started on
+localhost with a stub query callback.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+import loops
+import wire
+from network import P2PNetwork, PeerConnection
+from policies import FirstResponses
+
+
+def _sample_messages() -> List[Dict[str, object]]:
+    """Return a representative mix of query and response messages."""
+    answer = ("Here are a few vegan friendly Chinese restaurants near you, along with "
+              "reviews saved by people who have eaten there. ") * 8
+    return [
+        {'type': 'query', 'id': '0f8c6c1e-7a2b-4f4e-9d57-2b3c4d5e6f70',
+         'origin': '1BoatSLRHtKNngkdXEeobR76b53LETtpyT',
+         'payload': 'Which Chinese restaurants nearby have vegan dishes?'},
+        {'type': 'response', 'id': '0f8c6c1e-7a2b-4f4e-9d57-2b3c4d5e6f70',
+         'from': '1QAjmMvDk2tuyvqjZAQ4DgbKK4L3kNakAC', 'response': answer},
+    ]
+
+
+async def _codec_roundtrip(codec: wire.Codec, messages: List[Dict[str, object]], count: int) -> float:
+    """Send ``count`` messages over a loopback socket and return msgs/sec."""
+    done = asyncio.Event()
+    received = 0
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        nonlocal received
+        while received < count:
+            msg = await codec.read(reader)
+            if not msg:
+                break
+            received += 1
+        done.set()
+        writer.close()
+
+    server = await asyncio.start_server(handle, host='127.0.0.1', port=0)
+    port = server.sockets[0].getsockname()[1]
+    _, writer = await asyncio.open_connection('127.0.0.1', port)
+    start = time.perf_counter()
+    for i in range(count):
+        writer.write(codec.encode(messages[i % len(messages)]))
+        if i % 64 == 0:
+            await writer.drain()
+    await writer.drain()
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    return received / elapsed
+
+
+def bench_codec(args: argparse.Namespace) -> None:
+    """Compare the legacy JSON line encoding with the framed codecs."""
+    messages = _sample_messages()
+    names = ['jsonl'] + wire.available_codecs()
+    print(f"{'codec':<10}{'bytes/msg':>12}{'encode msg/s':>16}{'loopback msg/s':>18}")
+    for name in names:
+        codec = wire.get_codec(name)
+        size = sum(len(codec.encode(m)) for m in messages) / len(messages)
+        start = time.perf_counter()
+        for i in range(args.count):
+            codec.encode(messages[i % len(messages)])
+        encode_rate = args.count / (time.perf_counter() - start)
+        loop_rate = asyncio.run(_codec_roundtrip(codec, messages, args.count))
+        print(f"{name:<10}{size:>12.1f}{encode_rate:>16,.0f}{loop_rate:>18,.0f}")
+
+
+def _start_mesh(count: int, base_port: int, delay: float = 0.0, links: int = 2, shuffle: bool = False,
+                **kwargs) -> List[P2PNetwork]:
+    """Start ``count`` nodes on localhost, each connected to its predecessors.
+
+    Node ``i`` bootstraps from up to ``links`` earlier nodes so the mesh
+    is connected but not complete: the immediately preceding ones, or
+    random ones with ``shuffle``.  The stub callback sleeps ``delay``
+    seconds, standing in for an LLM call.  Query rate limits are off and
+    the per peer cap on queries being answered is raised unless given,
+    as the benchmarks deliberately flood the mesh from one origin.
+    """
+    for limit in ('peer_query_rate', 'peer_byte_rate', 'query_rate', 'byte_rate'):
+        kwargs.setdefault(limit, None)
+    kwargs.setdefault('max_inflight_per_peer', 10_000)
+    nodes: List[P2PNetwork] = []
+    for i in range(count):
+        async def on_query(query: str, port: int = base_port + i) -> str:
+            await asyncio.sleep(delay)
+            return f"answer from {port}"
+        earlier = random.sample(range(i), min(links, i)) if shuffle else range(max(0, i - links), i)
+        bootstrap = [f"127.0.0.1:{base_port + j}" for j in earlier]
+        node = P2PNetwork(base_port + i, bootstrap, on_query, **kwargs)
+        node.start()
+        nodes.append(node)
+        time.sleep(0.1)
+    time.sleep(0.5)
+    return nodes
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def _stress_local(node: P2PNetwork, concurrency: int, expected: int) -> List[Tuple[float, bool]]:
+    """Issue ``concurrency`` simultaneous queries from this (non network) loop.
+
+    Returns the latency of each query and whether it received a
+    response from every other node.
+    """
+    async def one(i: int) -> Tuple[float, bool]:
+        start = time.perf_counter()
+        responses = await node.run_threadsafe(node.query_peers(f"stress {i}"))
+        return time.perf_counter() - start, len(responses) == expected
+    return await asyncio.gather(*(one(i) for i in range(concurrency)))
+
+
+async def _stress_http(url: str, concurrency: int) -> List[Tuple[float, bool]]:
+    """Issue ``concurrency`` simultaneous ``/internal`` requests to a running node."""
+    import httpx
+
+    async with httpx.AsyncClient(base_url=url, timeout=60.0, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def one(i: int) -> Tuple[float, bool]:
+            start = time.perf_counter()
+            response = await client.get("/internal", params={"query": f"stress {i}"})
+            return time.perf_counter() - start, response.status_code == 200
+        return await asyncio.gather(*(one(i) for i in range(concurrency)))
+
+
+def bench_stress(args: argparse.Namespace) -> None:
+    """Drive many simultaneous queries across the HTTP/network loop boundary."""
+    start = time.perf_counter()
+    if args.url:
+        results = asyncio.run(_stress_http(args.url, args.concurrency))
+    else:
+        nodes = _start_mesh(args.nodes, args.port, delay=args.delay, max_send_queue=args.queue)
+        start = time.perf_counter()
+        results = asyncio.run(_stress_local(nodes[-1], args.concurrency, args.nodes - 1))
+        dropped = sum(peer['messages_dropped'] for node in nodes for peer in node.stats()['peers'].values())
+        print(f"{dropped} messages dropped by full send queues")
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, _ in results]
+    incomplete = sum(1 for _, complete in results if not complete)
+    print(f"{args.concurrency} concurrent queries in {elapsed:.2f}s "
+          f"({args.concurrency / elapsed:,.0f} queries/s), {incomplete} incomplete")
+    print(f"latency p50 {statistics.median(latencies) * 1000:.1f} ms, "
+          f"p99 {_percentile(latencies, 99) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms")
+
+
+async def _coverage(nodes: List[P2PNetwork], queries: int, ttl: int) -> List[int]:
+    """Send ``queries`` queries from random nodes and count the answers to each."""
+    counts = []
+    for i in range(queries):
+        origin = random.choice(nodes)
+        responses = await origin.run_threadsafe(origin.query_peers(f"gossip {i}", ttl=ttl, adaptive=False, timeout=5.0))
+        counts.append(len(responses))
+    return counts
+
+
+def bench_gossip(args: argparse.Namespace) -> None:
+    """Measure how coverage and message count vary with the fanout."""
+    random.seed(args.seed)
+    nodes = _start_mesh(args.nodes, args.port, links=args.links, shuffle=True, callback_mode='async',
+                        target_outbound=0, dht_refresh_interval=0)
+    degree = statistics.mean(len(node.peers) for node in nodes)
+    print(f"{args.nodes} nodes, mean degree {degree:.1f}, ttl {args.ttl}, {args.mode} selection")
+    print(f"{'fanout':<8}{'coverage':>10}{'min':>8}{'msgs/query':>13}{'msgs/node reached':>20}")
+    for fanout in (int(value) for value in args.fanouts.split(',')):
+        for node in nodes:
+            node.fanout = fanout or None
+            node.fanout_mode = args.mode
+        before = sum(node.query_messages_sent for node in nodes)
+        counts = asyncio.run(_coverage(nodes, args.queries, args.ttl))
+        messages = (sum(node.query_messages_sent for node in nodes) - before) / args.queries
+        coverage = statistics.mean(counts) / (args.nodes - 1)
+        reached = max(1.0, statistics.mean(counts))
+        print(f"{fanout or 'all':<8}{coverage:>10.1%}{min(counts) / (args.nodes - 1):>8.0%}"
+              f"{messages:>13.1f}{messages / reached:>20.2f}")
+
+
+async def _write_rate(codec: wire.Codec, senders: int, count: int, batch_bytes: int,
+                      batch_delay: float) -> Tuple[float, float]:
+    """Push ``count`` messages through a :class:`PeerConnection` from ``senders`` tasks.
+
+    :returns: Messages per second and messages per socket write.
+    """
+    messages = _sample_messages()
+    done = asyncio.Event()
+    received = 0
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        nonlocal received
+        while received < count:
+            if not await codec.read(reader):
+                break
+            received += 1
+        done.set()
+        writer.close()
+
+    server = await asyncio.start_server(handle, host='127.0.0.1', port=0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    peer = PeerConnection('bench', reader, writer, codec, outbound=True, max_queue=count,
+                          max_batch_bytes=batch_bytes, batch_delay=batch_delay)
+    peer.start()
+
+    async def sender(share: int) -> None:
+        for i in range(share):
+            peer.send(messages[i % len(messages)])
+            # Let the other senders and the writer task run, as
+            # independent producers on the network loop would.
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    shares = [count // senders + (1 if i < count % senders else 0) for i in range(senders)]
+    await asyncio.gather(*(sender(share) for share in shares))
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    per_write = peer.messages_sent / peer.writes if peer.writes else 0.0
+    peer.close()
+    server.close()
+    await server.wait_closed()
+    return received / elapsed, per_write
+
+
+def bench_writes(args: argparse.Namespace) -> None:
+    """Compare one write per message with coalesced writes."""
+    codec = wire.get_codec(wire.available_codecs()[0])
+    modes = [('single', 0, 0.0), ('coalesce', args.batch_bytes, 0.0)]
+    if args.delay > 0:
+        modes.append((f'delay {args.delay * 1000:g}ms', args.batch_bytes, args.delay))
+    print(f"{'senders':>8}  {'mode':<14}{'msgs/s':>12}{'msgs/write':>12}")
+    for senders in (int(n) for n in args.senders.split(',')):
+        for name, batch_bytes, delay in modes:
+            rate, per_write = asyncio.run(_write_rate(codec, senders, args.count, batch_bytes, delay))
+            print(f"{senders:>8}  {name:<14}{rate:>12,.0f}{per_write:>12.1f}")
+
+
+async def _round_trips(node: P2PNetwork, sequential: int, concurrent: int, expected: int
+                       ) -> Tuple[List[float], float, int]:
+    """Time queries from ``node`` one at a time, then ``concurrent`` at once.
+
+    :returns: The sequential latencies, the concurrent throughput in
+        queries per second and the number of incomplete queries.
+    """
+    latencies = []
+    incomplete = 0
+    for i in range(sequential):
+        start = time.perf_counter()
+        responses = await node.run_threadsafe(node.query_peers(f"rtt {i}", ttl=expected, adaptive=False))
+        latencies.append(time.perf_counter() - start)
+        incomplete += len(responses) != expected
+    start = time.perf_counter()
+    results = await asyncio.gather(*(node.run_threadsafe(node.query_peers(f"load {i}", ttl=expected, adaptive=False))
+                                     for i in range(concurrent)))
+    rate = concurrent / (time.perf_counter() - start)
+    incomplete += sum(1 for responses in results if len(responses) != expected)
+    return latencies, rate, incomplete
+
+
+def bench_loops(args: argparse.Namespace) -> None:
+    """Compare query latency and throughput on asyncio and uvloop meshes."""
+    names = loops.available_loops()
+    if 'uvloop' not in names:
+        print("uvloop is not installed; only the asyncio loop is measured")
+    print(f"{'loop':<9}{'p50 ms':>9}{'p99 ms':>9}{'queries/s':>12}{'msgs/s':>10}{'incomplete':>12}")
+    for index, name in enumerate(names):
+        nodes = _start_mesh(args.nodes, args.port + index * args.nodes, callback_mode='async', target_outbound=0,
+                            dht_refresh_interval=0, max_send_queue=10_000, event_loop=name)
+        before = sum(node.query_messages_sent for node in nodes)
+        driver = loops.new_event_loop(name)
+        try:
+            latencies, rate, incomplete = driver.run_until_complete(
+                _round_trips(nodes[-1], args.queries, args.concurrency, args.nodes - 1))
+        finally:
+            driver.close()
+        # Every query message reached a node that replied once.
+        queries = args.queries + args.concurrency
+        messages = 2 * (sum(node.query_messages_sent for node in nodes) - before)
+        print(f"{name:<9}{statistics.median(latencies) * 1000:>9.2f}{_percentile(latencies, 99) * 1000:>9.2f}"
+              f"{rate:>12,.0f}{messages / queries * rate:>10,.0f}{incomplete:>12}")
+
+
+def bench_quorum(args: argparse.Namespace) -> None:
+    """Check that a ``FirstResponses(k)`` query returns exactly ``k`` answers.
+
+    Every other node is a direct peer of the origin and answers at
+    once, so the answers arrive close together.
+    """
+    nodes = _start_mesh(args.nodes, args.port, links=args.nodes, callback_mode='async', target_outbound=0,
+                        dht_refresh_interval=0)
+    origin = nodes[-1]
+    failures = 0
+    print(f"{'quorum':<8}{'answers':>9}")
+    for count in range(1, len(origin.peers) + 1):
+        for i in range(args.queries):
+            responses = asyncio.run(origin.run_threadsafe(
+                origin.query_peers(f"quorum {count} {i}", ttl=1, adaptive=False, policy=FirstResponses(count))))
+            if len(responses) != count:
+                failures += 1
+        print(f"{count:<8}{len(responses):>9}")
+    print(f"{failures} queries returned the wrong number of answers")
+    if failures:
+        raise SystemExit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='P2P networking micro benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    codec = sub.add_parser('codec', help='wire codec size and throughput')
+    codec.add_argument('--count', type=int, default=50_000)
+    codec.set_defaults(func=bench_codec)
+
+    stress = sub.add_parser('stress', help='concurrent queries from a foreign event loop')
+    stress.add_argument('--concurrency', type=int, default=500)
+    stress.add_argument('--nodes', type=int, default=5)
+    stress.add_argument('--port', type=int, default=19000)
+    stress.add_argument('--delay', type=float, default=0.0, help='stub callback latency in seconds')
+    stress.add_argument('--queue', type=int, default=10_000, help='per-peer send queue size')
+    stress.add_argument('--url', help='drive GET /internal on a running node instead, e.g. http://localhost:8001')
+    stress.set_defaults(func=bench_stress)
+
+    gossip = sub.add_parser('gossip', help='coverage and message count against fanout')
+    gossip.add_argument('--nodes', type=int, default=50)
+    gossip.add_argument('--links', type=int, default=4, help='bootstrap links per node; mean degree is about twice this')
+    gossip.add_argument('--ttl', type=int, default=6)
+    gossip.add_argument('--fanouts', default='1,2,3,4,6,0', help='comma separated; 0 floods to all peers')
+    gossip.add_argument('--mode', choices=('random', 'weighted'), default='random')
+    gossip.add_argument('--queries', type=int, default=50)
+    gossip.add_argument('--port', type=int, default=19100)
+    gossip.add_argument('--seed', type=int, default=1)
+    gossip.set_defaults(func=bench_gossip)
+
+    writes = sub.add_parser('writes', help='write coalescing throughput against concurrent senders')
+    writes.add_argument('--senders', default='1,10,100', help='comma separated sender counts')
+    writes.add_argument('--count', type=int, default=50_000)
+    writes.add_argument('--batch-bytes', type=int, default=65536)
+    writes.add_argument('--delay', type=float, default=0.0, help='also run with this batching delay in seconds')
+    writes.set_defaults(func=bench_writes)
+
+    loop = sub.add_parser('loops', help='query latency and throughput per event loop implementation')
+    loop.add_argument('--nodes', type=int, default=10)
+    loop.add_argument('--queries', type=int, default=200, help='sequential queries timed for latency')
+    loop.add_argument('--concurrency', type=int, default=500, help='simultaneous queries timed for throughput')
+    loop.add_argument('--port', type=int, default=19300)
+    loop.set_defaults(func=bench_loops)
+
+    quorum = sub.add_parser('quorum', help='check that quorum queries return as many answers as asked for')
+    quorum.add_argument('--nodes', type=int, default=6)
+    quorum.add_argument('--queries', type=int, default=20, help='queries per quorum size')
+    quorum.add_argument('--port', type=int, default=19400)
+    quorum.set_defaults(func=bench_quorum)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
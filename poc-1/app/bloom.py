@@ -0,0 +1,106 @@
+"""
+bloom.py
+~~~~~~~~
+
+A small Bloom filter.  A Bloom filter answers "have I seen this
+before?" in a fixed amount of memory.  It never forgets an item it
+was given but may wrongly claim to have seen an item it was not; the
+chance of that false positive grows as the filter fills up and can be
+estimated from the fraction of bits that are set.
+
+Items are hashed once with BLAKE2b into 128 bits and the ``k`` bit
+positions are derived from the two 64‑bit halves using double
+hashing, so the cost of an operation does not depend on the size of
+the item.
+
+Filters can be serialised with :meth:`BloomFilter.to_bytes` so that a
+node can tell its peers what it holds in a few kilobytes.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import math
+import struct
+
+# Header of the serialised form: number of bits, number of hashes and
+# number of items added.
+_HEADER = struct.Struct('>IBI')
+
+
+class BloomFilter:
+    """A fixed size Bloom filter over byte strings.
+
+    :param capacity: Number of items the filter is sized for.
+    :param error_rate: Target false positive rate once ``capacity``
+        items have been added.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        if capacity <= 0 or not 0.0 < error_rate < 1.0:
+            raise ValueError("capacity must be positive and error_rate between 0 and 1")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Optimal sizing: m = -n ln p / (ln 2)^2 bits and k = m/n ln 2 hashes.
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self.bits_set = 0
+        self.count = 0
+
+    def add(self, item: bytes) -> None:
+        """Add ``item`` to the filter."""
+        bits = self._bits
+        for index in self._indexes(item):
+            byte, mask = index >> 3, 1 << (index & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                self.bits_set += 1
+        self.count += 1
+
+    def __contains__(self, item: bytes) -> bool:
+        bits = self._bits
+        return all(bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(item))
+
+    @property
+    def memory_bytes(self) -> int:
+        """Size of the bit array in bytes."""
+        return len(self._bits)
+
+    def to_bytes(self) -> bytes:
+        """Serialise the filter for sending to another node."""
+        return _HEADER.pack(self.num_bits, self.num_hashes, self.count) + bytes(self._bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BloomFilter':
+        """Rebuild a filter serialised with :meth:`to_bytes`.
+
+        :raises ValueError: If ``data`` is not a valid filter.
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError("truncated Bloom filter")
+        num_bits, num_hashes, count = _HEADER.unpack_from(data)
+        bits = bytearray(data[_HEADER.size:])
+        if num_bits < 8 or num_hashes < 1 or len(bits) != (num_bits + 7) // 8:
+            raise ValueError("malformed Bloom filter")
+        bloom = cls.__new__(cls)
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom._bits = bits
+        bloom.bits_set = int.from_bytes(bits, 'big').bit_count()
+        bloom.count = count
+        bloom.capacity = max(1, count)
+        bloom.error_rate = bloom.false_positive_rate()
+        return bloom
+
+    def false_positive_rate(self) -> float:
+        """Estimate the current false positive rate from the fill ratio."""
+        return (self.bits_set / self.num_bits) ** self.num_hashes
+
+    def _indexes(self, item: bytes):
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        m = self.num_bits
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % m
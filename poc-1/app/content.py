@@ -0,0 +1,63 @@
+"""
+content.py
+~~~~~~~~~~
+
+Content summaries for selective query routing.  A node describes what
+it hosts as the set of terms appearing in its content and sends its
+peers a :class:`bloom.BloomFilter` of those terms.  Before sending a
+query to a peer a node checks whether any of the query's terms is in
+the peer's filter; peers that cannot have anything relevant are
+skipped, so the query, and the LLM work answering it, only reaches
+nodes that may know the answer.
+
+Terms are lower case words of at least three letters that are not
+common English stop words.  The filter has false positives but no
+false negatives: a peer is never skipped for a term it has.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Iterable, Optional, Set
+
+from bloom import BloomFilter
+
+# False positive rate of advertised filters.
+FILTER_ERROR_RATE = 0.01
+# Filters are sized for at least this many terms so that small
+# content sets do not produce uselessly small filters.
+MIN_FILTER_CAPACITY = 256
+
+_WORD = re.compile(r"[a-z0-9]{3,}")
+STOP_WORDS = frozenset("""
+    the and for are but not you all any can had her was one our out has him his how its may new now
+    own say she too use who why with that this from they them then than there their what when where
+    which while will would could should have been into only over some such very also just about more
+    most other your does did doing being each few off once same both here after before again further
+    please tell know want need like give find show
+""".split())
+
+
+def terms(text: str) -> Set[str]:
+    """Return the searchable terms in ``text``."""
+    return {word for word in _WORD.findall(text.lower()) if word not in STOP_WORDS}
+
+
+def build_filter(content_terms: Iterable[str]) -> BloomFilter:
+    """Build the filter advertising ``content_terms``."""
+    unique = set(content_terms)
+    bloom = BloomFilter(max(MIN_FILTER_CAPACITY, len(unique)), FILTER_ERROR_RATE)
+    for term in unique:
+        bloom.add(term.encode('utf-8'))
+    return bloom
+
+
+def matches(bloom: Optional[BloomFilter], query_terms: Set[str]) -> bool:
+    """Return ``True`` if a peer advertising ``bloom`` may be able to answer.
+
+    Peers that advertise no filter, and queries without any terms,
+    always match.
+    """
+    if bloom is None or not query_terms:
+        return True
+    return any(term.encode('utf-8') in bloom for term in query_terms)
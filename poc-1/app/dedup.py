@@ -0,0 +1,87 @@
+"""
+dedup.py
+~~~~~~~~
+
+Bounded memory of recently seen message IDs.  Flooded queries reach a
+node several times over different paths; the node must recognise the
+repeats without keeping every ID it has ever seen.
+
+:class:`DedupCache` keeps two generations of :class:`bloom.BloomFilter`.
+New IDs go into the current generation and lookups check both.  When
+the current generation has been in use for ``ttl`` seconds, or has
+received ``capacity`` IDs, the older generation is discarded and a
+fresh one takes its place.  An ID is therefore remembered for at
+least ``ttl`` seconds unless more than ``capacity`` IDs arrive within
+that window, and memory use never exceeds two filters.
+
+IDs are UUID strings; they are reduced to their 16 raw bytes before
+hashing.  IDs that are not valid UUIDs are accepted as well and are
+hashed as UTF‑8 text.
+"""
+
+from __future__ import annotations
+
+import time
+import uuid
+from typing import Dict
+
+from bloom import BloomFilter
+
+
+class DedupCache:
+    """Time and size bounded set of message IDs.
+
+    :param capacity: Number of IDs a single generation holds.
+    :param ttl: Seconds after which a generation is rotated out.
+    :param error_rate: Target false positive rate of each generation.
+        A false positive makes the node treat a new message as a
+        duplicate, so this should be small.
+    """
+
+    def __init__(self, capacity: int = 100_000, ttl: float = 600.0, error_rate: float = 1e-6):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = BloomFilter(capacity, error_rate)
+        self._rotated_at = time.monotonic()
+        self.rotations = 0
+
+    def add(self, message_id: str) -> None:
+        """Remember ``message_id``."""
+        self._maybe_rotate()
+        self._current.add(self._key(message_id))
+
+    def __contains__(self, message_id: str) -> bool:
+        self._maybe_rotate()
+        key = self._key(message_id)
+        return key in self._current or key in self._previous
+
+    def false_positive_rate(self) -> float:
+        """Estimated probability that an unseen ID is reported as seen."""
+        return 1.0 - (1.0 - self._current.false_positive_rate()) * (1.0 - self._previous.false_positive_rate())
+
+    def stats(self) -> Dict[str, object]:
+        """Return size and accuracy metrics for monitoring."""
+        return {
+            'entries': self._current.count + self._previous.count,
+            'capacity': 2 * self.capacity,
+            'memory_bytes': self._current.memory_bytes + self._previous.memory_bytes,
+            'false_positive_rate': self.false_positive_rate(),
+            'rotations': self.rotations,
+        }
+
+    @staticmethod
+    def _key(message_id: str) -> bytes:
+        try:
+            return uuid.UUID(message_id).bytes
+        except ValueError:
+            return message_id.encode('utf-8')
+
+    def _maybe_rotate(self) -> None:
+        now = time.monotonic()
+        if self._current.count >= self.capacity or now - self._rotated_at >= self.ttl:
+            self._previous = self._current
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._rotated_at = now
+            self.rotations += 1
@@ -0,0 +1,167 @@
+"""
+dht.py
+~~~~~~
+
+A Kademlia style routing table.  Node addresses (see
+:meth:`network.P2PNetwork._derive_address`) embed the RIPEMD‑160 hash of
+the node's key, which makes them natural 160‑bit node IDs.  Content
+keys are mapped into the same space with SHA‑1.
+
+The distance between two IDs is their XOR.  A node keeps up to ``k``
+contacts for every distance range ``[2**i, 2**(i+1))`` ("k‑buckets"),
+so it knows many nodes close to itself and a few far away.  Asking
+the closest known nodes for even closer ones halves the remaining
+distance with every round, which lets a lookup find any node or key
+in ``O(log N)`` steps.
+
+Full buckets keep their long lived contacts, as those are the most
+likely to stay up.  Newly seen contacts wait in a small replacement
+cache and take over when a contact stops answering.
+"""
+
+from __future__ import annotations
+
+import hashlib
+from typing import Dict, List, Optional, Set
+
+ID_BITS = 160
+# Bucket size and lookup parallelism, as in the Kademlia paper.
+K = 20
+ALPHA = 3
+
+_B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+def key_id(key: str) -> int:
+    """Map a content key to a 160‑bit ID."""
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest(), 'big')
+
+
+def node_id(address: str) -> int:
+    """Return the 160‑bit ID of a node address.
+
+    This is the RIPEMD‑160 hash inside the Base58Check encoding.
+    Strings that are not such addresses are hashed like content keys.
+    """
+    num = 0
+    try:
+        for char in address:
+            num = num * 58 + _B58_ALPHABET.index(char)
+        raw = num.to_bytes(25, 'big')
+    except (ValueError, OverflowError):
+        return key_id(address)
+    return int.from_bytes(raw[1:21], 'big')
+
+
+class Contact:
+    """A node the routing table knows how to reach.
+
+    :param address: The node's address.
+    :param host: Host the node accepts connections on.
+    :param port: Port the node accepts connections on.
+    """
+
+    def __init__(self, address: str, host: str, port: int):
+        self.address = address
+        self.host = host
+        self.port = port
+        self.id = node_id(address)
+
+    def to_wire(self) -> List[object]:
+        return [self.address, self.host, self.port]
+
+    @classmethod
+    def from_wire(cls, entry: object) -> Optional['Contact']:
+        """Parse a ``[address, host, port]`` triple, or return ``None``."""
+        if not isinstance(entry, list) or len(entry) != 3:
+            return None
+        address, host, port = entry
+        if not isinstance(address, str) or not isinstance(host, str) or not isinstance(port, int):
+            return None
+        if not 0 < port < 65536:
+            return None
+        return cls(address, host, port)
+
+
+class RoutingTable:
+    """XOR metric k‑bucket table around ``own_id``.
+
+    :param own_id: This node's ID.
+    :param k: Contacts per bucket.
+    :param replacements: Size of each bucket's replacement cache.
+    """
+
+    def __init__(self, own_id: int, k: int = K, replacements: int = K):
+        self.own_id = own_id
+        self.k = k
+        self.replacements = replacements
+        # Least recently seen contact first.
+        self._buckets: List[List[Contact]] = [[] for _ in range(ID_BITS)]
+        self._replacements: List[List[Contact]] = [[] for _ in range(ID_BITS)]
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self._buckets)
+
+    def update(self, contact: Contact) -> None:
+        """Note that ``contact`` was just heard from."""
+        index = self._bucket_index(contact.id)
+        if index is None:
+            return
+        bucket = self._buckets[index]
+        for position, known in enumerate(bucket):
+            if known.id == contact.id:
+                del bucket[position]
+                bucket.append(contact)
+                return
+        if len(bucket) < self.k:
+            bucket.append(contact)
+            return
+        cache = self._replacements[index]
+        cache[:] = [known for known in cache if known.id != contact.id]
+        cache.append(contact)
+        del cache[:-self.replacements]
+
+    def remove(self, contact_id: int) -> None:
+        """Drop a contact that stopped answering, promoting a replacement."""
+        index = self._bucket_index(contact_id)
+        if index is None:
+            return
+        bucket = self._buckets[index]
+        remaining = [known for known in bucket if known.id != contact_id]
+        if len(remaining) == len(bucket):
+            return
+        bucket[:] = remaining
+        cache = self._replacements[index]
+        if cache:
+            bucket.append(cache.pop())
+
+    def closest(self, target: int, count: int = K, exclude: Optional[Set[int]] = None) -> List[Contact]:
+        """Return up to ``count`` known contacts closest to ``target``."""
+        contacts = [contact for bucket in self._buckets for contact in bucket
+                    if not exclude or contact.id not in exclude]
+        contacts.sort(key=lambda contact: contact.id ^ target)
+        return contacts[:count]
+
+    def find(self, contact_id: int) -> Optional[Contact]:
+        """Return the contact with ``contact_id`` if it is in the table."""
+        index = self._bucket_index(contact_id)
+        if index is None:
+            return None
+        for contact in self._buckets[index]:
+            if contact.id == contact_id:
+                return contact
+        return None
+
+    def stats(self) -> Dict[str, object]:
+        """Return occupancy figures for monitoring."""
+        return {
+            'contacts': len(self),
+            'buckets_used': sum(1 for bucket in self._buckets if bucket),
+            'replacements': sum(len(cache) for cache in self._replacements),
+        }
+
+    def _bucket_index(self, contact_id: int) -> Optional[int]:
+        distance = contact_id ^ self.own_id
+        if distance == 0:
+            return None
+        return distance.bit_length() - 1
@@ -0,0 +1,72 @@
+"""
+expiring.py
+~~~~~~~~~~~
+
+A dictionary whose entries expire.  Used for short lived per‑query
+state, such as which peer a query arrived from, that must not grow
+without bound on a busy node.
+"""
+
+from __future__ import annotations
+
+import collections
+import time
+from typing import Generic, List, Optional, Tuple, TypeVar
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+class ExpiringDict(Generic[K, V]):
+    """Mapping with a maximum size and a per‑entry time to live.
+
+    Entries older than ``ttl`` seconds are dropped lazily on access.
+    When the mapping is full, inserting a new key evicts the oldest
+    entry.
+
+    :param max_size: Maximum number of entries kept.
+    :param ttl: Seconds after insertion at which an entry expires.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: collections.OrderedDict[K, Tuple[float, V]] = collections.OrderedDict()
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self._expire()
+        self._data.pop(key, None)
+        self._data[key] = (time.monotonic(), value)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        self._expire()
+        entry = self._data.get(key)
+        return default if entry is None else entry[1]
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __contains__(self, key: object) -> bool:
+        self._expire()
+        return key in self._data
+
+    def __len__(self) -> int:
+        self._expire()
+        return len(self._data)
+
+    def items(self) -> List[Tuple[K, V]]:
+        """Return a snapshot of the live entries, oldest first."""
+        self._expire()
+        return [(key, value) for key, (_, value) in self._data.items()]
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        data = self._data
+        while data:
+            key, (inserted, _) = next(iter(data.items()))
+            if inserted > cutoff:
+                break
+            del data[key]
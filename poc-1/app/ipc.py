@@ -0,0 +1,317 @@
+"""
+ipc.py
+~~~~~~
+
+Local IPC between a P2P daemon and HTTP worker processes.
+
+A :class:`network.P2PNetwork` lives in one process, but a single
+process only uses one core for HTTP handling and orchestration.  In
+the split deployment of :mod:`main` the network runs in a daemon
+process which serves it on a Unix socket through :class:`IpcServer`,
+and any number of HTTP worker processes reach it with an
+:class:`IpcClient`.
+
+Both sides use the framed codec of :mod:`wire` (MessagePack when
+installed); they come from the same installation, so no handshake is
+needed.  A worker keeps one connection open and multiplexes requests
+over it, each tagged with an ``id`` it chooses:
+
+* ``query`` – broadcast ``query`` to the peers, optionally stopping
+  after ``quorum`` answers.  The daemon sends an ``item`` carrying the
+  ``value`` of each peer answer as it arrives and an ``end`` after the
+  last.
+* ``agent`` – send ``query`` to the node with ``address`` only.
+  Answered with one ``result``.
+* ``stats`` – answered with a ``result`` holding the network's stats.
+* ``content`` – replace the content ``terms`` of the worker's owner
+  submissions, which land in the worker.  The daemon advertises the
+  union of all workers' terms as its content filter (see
+  :meth:`IpcServer.content_terms`).  Answered with an empty ``result``.
+* ``cancel`` – abandon the request with this ``id``, e.g. because the
+  HTTP client went away.
+
+Failed requests are answered with an ``error`` carrying a message and
+a ``kind``: ``lookup`` if the target node could not be found,
+``internal`` otherwise.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from network import P2PNetwork
+from policies import ALL_RESPONSES, FirstResponses
+from wire import available_codecs, get_codec
+
+# Default location of the daemon's socket.
+DEFAULT_PATH = '/tmp/elmnet-p2p.sock'
+
+CODEC = get_codec(available_codecs()[0])
+
+
+class IpcServer:
+    """Serves a P2P network to worker processes on a Unix socket.
+
+    :param network: The network requests run on.
+    :param path: Filesystem path of the socket.
+    """
+
+    def __init__(self, network: P2PNetwork, path: str = DEFAULT_PATH):
+        self.network = network
+        self.path = path
+        self.clients = 0
+        self.requests = 0
+        # Content terms reported by each connected worker.
+        self._content: Dict[int, Set[str]] = {}
+        self._next_client = 0
+
+    def content_terms(self) -> Set[str]:
+        """Return the content terms of all connected workers.
+
+        Suitable as the network's ``content_terms`` callback.
+        """
+        found: Set[str] = set()
+        for client_terms in list(self._content.values()):
+            found |= client_terms
+        return found
+
+    async def serve(self) -> None:
+        """Listen on :attr:`path` until cancelled.  Must run on the network's loop."""
+        # A socket file left behind by a previous daemon blocks bind().
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle_client, path=self.path)
+        os.chmod(self.path, 0o600)
+        print(f"IPC endpoint listening on {self.path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Run the requests of one worker until it disconnects."""
+        self.clients += 1
+        self._next_client += 1
+        client = self._next_client
+        tasks: Dict[int, asyncio.Task] = {}
+        drain_lock = asyncio.Lock()
+
+        async def send(message: Dict[str, object]) -> None:
+            if writer.is_closing():
+                return
+            writer.write(CODEC.encode(message))
+            async with drain_lock:
+                await writer.drain()
+
+        try:
+            while True:
+                msg = await CODEC.read(reader)
+                if not msg:
+                    break
+                rid = msg.get('id')
+                if not isinstance(rid, int):
+                    continue
+                if msg.get('type') == 'cancel':
+                    task = tasks.pop(rid, None)
+                    if task is not None:
+                        task.cancel()
+                    continue
+                if msg.get('type') == 'content':
+                    content = msg.get('terms')
+                    if not isinstance(content, list):
+                        content = []
+                    self._content[client] = {term for term in content if isinstance(term, str)}
+                    await send({'type': 'result', 'id': rid, 'value': None})
+                    continue
+                self.requests += 1
+                task = asyncio.get_running_loop().create_task(self._serve_request(msg, rid, send))
+                tasks[rid] = task
+                task.add_done_callback(lambda _, rid=rid: tasks.pop(rid, None))
+        finally:
+            self.clients -= 1
+            self._content.pop(client, None)
+            for task in list(tasks.values()):
+                task.cancel()
+            writer.close()
+
+    async def _serve_request(self, msg: Dict[str, object], rid: int,
+                             send: Callable[[Dict[str, object]], Awaitable[None]]) -> None:
+        mtype = msg.get('type')
+        try:
+            if mtype == 'query':
+                query = msg.get('query')
+                if not isinstance(query, str):
+                    raise ValueError("query must be a string")
+                quorum = msg.get('quorum')
+                policy = FirstResponses(quorum) if isinstance(quorum, int) and quorum > 0 else ALL_RESPONSES
+                async for response in self.network.query_peers_stream(query, policy=policy):
+                    await send({'type': 'item', 'id': rid, 'value': response})
+                await send({'type': 'end', 'id': rid})
+            elif mtype == 'agent':
+                address, query = msg.get('address'), msg.get('query')
+                if not isinstance(address, str) or not isinstance(query, str):
+                    raise ValueError("address and query must be strings")
+                result = await self.network.query_agent(address, query)
+                await send({'type': 'result', 'id': rid, 'value': result})
+            elif mtype == 'stats':
+                await send({'type': 'result', 'id': rid, 'value': self.network.stats()})
+            else:
+                raise ValueError(f"unknown request type {mtype!r}")
+        except asyncio.CancelledError:
+            raise
+        except LookupError as exc:
+            await send({'type': 'error', 'id': rid, 'kind': 'lookup', 'error': str(exc)})
+        except (ConnectionError, OSError):
+            pass
+        except Exception as exc:
+            await send({'type': 'error', 'id': rid, 'kind': 'internal', 'error': str(exc)})
+
+
+class IpcClient:
+    """A worker's connection to the daemon's :class:`IpcServer`.
+
+    The connection is opened on first use and reopened after the
+    daemon restarts.  An instance belongs to the event loop it is
+    first used on.
+
+    :param path: Filesystem path of the daemon's socket.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._replies: Dict[int, asyncio.Queue] = {}
+        self._next_id = 0
+        # Content terms last sent, resent whenever the connection is
+        # reopened.
+        self._content: Optional[List[str]] = None
+        self._open_lock: Optional[asyncio.Lock] = None
+        self._drain_lock: Optional[asyncio.Lock] = None
+
+    async def query(self, query: str, quorum: Optional[int] = None) -> List[object]:
+        """Broadcast ``query`` through the daemon and return the peer answers."""
+        return [response async for response in self.stream(query, quorum)]
+
+    async def stream(self, query: str, quorum: Optional[int] = None) -> AsyncIterator[object]:
+        """Broadcast ``query`` through the daemon, yielding peer answers as they arrive.
+
+        :raises ConnectionError: If the daemon cannot be reached.
+        """
+        rid, replies = await self._request({'type': 'query', 'query': query, 'quorum': quorum})
+        finished = False
+        try:
+            while True:
+                reply = await replies.get()
+                if reply.get('type') == 'item':
+                    yield reply.get('value')
+                    continue
+                finished = True
+                if reply.get('type') != 'end':
+                    _raise_error(reply)
+                return
+        finally:
+            self._replies.pop(rid, None)
+            if not finished and self._writer is not None and not self._writer.is_closing():
+                self._writer.write(CODEC.encode({'type': 'cancel', 'id': rid}))
+
+    async def query_agent(self, address: str, query: str) -> object:
+        """Send ``query`` to the node ``address`` through the daemon.
+
+        :raises LookupError: If the node cannot be found.
+        :raises ConnectionError: If the daemon cannot be reached.
+        """
+        return await self._call({'type': 'agent', 'address': address, 'query': query})
+
+    async def stats(self) -> Dict[str, object]:
+        """Return the daemon's network stats."""
+        return await self._call({'type': 'stats'})  # type: ignore[return-value]
+
+    async def set_content(self, terms: Iterable[str]) -> None:
+        """Report the content terms of this worker's owner submissions.
+
+        Nothing is sent if they did not change.
+
+        :raises ConnectionError: If the daemon cannot be reached.
+        """
+        content = sorted(terms)
+        if content == self._content and self._writer is not None and not self._writer.is_closing():
+            return
+        self._content = content
+        await self._call({'type': 'content', 'terms': content})
+
+    async def _call(self, message: Dict[str, object]) -> object:
+        rid, replies = await self._request(message)
+        try:
+            reply = await replies.get()
+        finally:
+            self._replies.pop(rid, None)
+        if reply.get('type') != 'result':
+            _raise_error(reply)
+        return reply.get('value')
+
+    async def _request(self, message: Dict[str, object]) -> Tuple[int, asyncio.Queue]:
+        """Send a request and return its id and the queue its replies arrive on."""
+        writer = await self._open()
+        self._next_id += 1
+        rid = self._next_id
+        replies: asyncio.Queue = asyncio.Queue()
+        self._replies[rid] = replies
+        writer.write(CODEC.encode({**message, 'id': rid}))
+        try:
+            async with self._drain_lock:  # type: ignore[union-attr]
+                await writer.drain()
+        except OSError as exc:
+            self._replies.pop(rid, None)
+            raise ConnectionError(f"Lost connection to the P2P daemon: {exc}") from exc
+        return rid, replies
+
+    async def _open(self) -> asyncio.StreamWriter:
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+            self._drain_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self._writer is None or self._writer.is_closing():
+                try:
+                    reader, writer = await asyncio.open_unix_connection(self.path)
+                except OSError as exc:
+                    raise ConnectionError(f"P2P daemon not reachable at {self.path}: {exc}") from exc
+                self._writer = writer
+                asyncio.get_running_loop().create_task(self._read_replies(reader, writer))
+                if self._content is not None:
+                    # A restarted daemon has forgotten this worker's content.
+                    self._next_id += 1
+                    writer.write(CODEC.encode({'type': 'content', 'terms': self._content, 'id': self._next_id}))
+            return self._writer
+
+    async def _read_replies(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Route replies to their requests until the connection closes."""
+        try:
+            while True:
+                msg = await CODEC.read(reader)
+                if not msg:
+                    break
+                replies = self._replies.get(msg.get('id'))  # type: ignore[arg-type]
+                if replies is not None:
+                    replies.put_nowait(msg)
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+            for replies in self._replies.values():
+                replies.put_nowait({'type': 'error', 'kind': 'connection',
+                                    'error': 'connection to the P2P daemon was lost'})
+
+
+def _raise_error(reply: Dict[str, object]) -> None:
+    """Raise the exception matching an ``error`` reply."""
+    message = str(reply.get('error', 'unexpected reply from the P2P daemon'))
+    kind = reply.get('kind')
+    if kind == 'lookup':
+        raise LookupError(message)
+    if kind == 'connection':
+        raise ConnectionError(message)
+    raise RuntimeError(message)
@@ -0,0 +1,134 @@
+"""
+latency.py
+~~~~~~~~~~
+
+Round trip time estimation for peer connections.
+
+:class:`RttEstimator` smooths ping/pong samples the way TCP does
+(RFC 6298): it keeps an exponentially weighted mean (SRTT) and mean
+deviation (RTTVAR) of the samples.  ``SRTT + 4 * RTTVAR`` is a
+conservative bound on how long a reply from the peer can reasonably
+take, which makes it a good basis for timeouts.
+
+:class:`LatencyHistogram` records how long queries take to be
+answered.  Answers depend on the peer's callback rather than on the
+network, so their distribution is wide and skewed; the histogram keeps
+enough of its shape to read off percentiles such as the p95.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Dict, List, Optional
+
+# Gains from RFC 6298.
+ALPHA = 1 / 8
+BETA = 1 / 4
+
+
+class RttEstimator:
+    """Smoothed round trip time of a single peer, in seconds."""
+
+    def __init__(self):
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.samples = 0
+        self.last: Optional[float] = None
+
+    def update(self, sample: float) -> None:
+        """Feed a new round trip measurement."""
+        if self.srtt is None or self.rttvar is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - sample)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * sample
+        self.last = sample
+        self.samples += 1
+
+    @property
+    def rto(self) -> Optional[float]:
+        """Upper bound on an expected round trip, or ``None`` without samples."""
+        if self.srtt is None or self.rttvar is None:
+            return None
+        return self.srtt + 4 * self.rttvar
+
+    def stats(self) -> Dict[str, object]:
+        """Return the estimate in milliseconds for monitoring."""
+        def ms(value: Optional[float]) -> Optional[float]:
+            return None if value is None else round(value * 1000, 3)
+        return {
+            'srtt_ms': ms(self.srtt),
+            'rttvar_ms': ms(self.rttvar),
+            'rto_ms': ms(self.rto),
+            'last_ms': ms(self.last),
+            'samples': self.samples,
+        }
+
+
+class LatencyHistogram:
+    """Log‑bucketed histogram of latencies in seconds.
+
+    Bucket boundaries grow by a factor of 2**(1/4), about 19%, starting
+    at one millisecond, so percentiles are accurate to within that
+    factor from milliseconds to hours with a fixed number of buckets.
+    Once ``window`` samples have accumulated all counts are halved;
+    old samples fade out and the percentiles follow changes in the
+    peers.
+
+    :param window: Number of samples after which counts are halved.
+    """
+
+    MIN = 0.001
+    GROWTH = 2 ** 0.25
+    BUCKETS = 96
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._counts: List[int] = [0] * self.BUCKETS
+        # Weight currently held in the buckets, and samples ever recorded.
+        self.count = 0
+        self.total = 0
+
+    def record(self, value: float) -> None:
+        """Add a latency sample."""
+        self._counts[self._bucket(value)] += 1
+        self.count += 1
+        self.total += 1
+        if self.count >= self.window:
+            self._counts = [c // 2 for c in self._counts]
+            self.count = sum(self._counts)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Return the upper bound of the bucket holding the ``pct`` percentile.
+
+        ``None`` is returned while the histogram is empty.
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(pct / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return self.MIN * self.GROWTH ** index
+        return self.MIN * self.GROWTH ** (self.BUCKETS - 1)
+
+    def stats(self) -> Dict[str, object]:
+        """Return the sample count and common percentiles in milliseconds."""
+        def ms(pct: float) -> Optional[float]:
+            value = self.percentile(pct)
+            return None if value is None else round(value * 1000, 3)
+        return {
+            'samples': self.total,
+            'p50_ms': ms(50),
+            'p90_ms': ms(90),
+            'p95_ms': ms(95),
+            'p99_ms': ms(99),
+        }
+
+    def _bucket(self, value: float) -> int:
+        if value <= self.MIN:
+            return 0
+        index = math.ceil(math.log(value / self.MIN, self.GROWTH))
+        return min(index, self.BUCKETS - 1)
@@ -0,0 +1,64 @@
+"""
+loops.py
+~~~~~~~~
+
+Event loop selection.  Both the P2P network and uvicorn run on an
+asyncio event loop; either can use `uvloop`_, a drop‑in replacement
+built on libuv which handles sockets with considerably less overhead.
+
+The implementation is chosen by name:
+
+* ``asyncio`` – the standard library loop.
+* ``uvloop`` – uvloop, falling back to ``asyncio`` with a warning if
+  the optional ``uvloop`` package is not installed.
+* ``auto`` – uvloop if it is installed, otherwise ``asyncio``.  This
+  is what uvicorn does by default as well.
+
+.. _uvloop: https://github.com/MagicStack/uvloop
+"""
+
+from __future__ import annotations
+
+import asyncio
+from typing import List
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover - optional dependency
+    uvloop = None
+
+LOOP_IMPLEMENTATIONS = ('auto', 'uvloop', 'asyncio')
+
+
+def available_loops() -> List[str]:
+    """Return the loop implementations usable in this environment."""
+    return ['uvloop', 'asyncio'] if uvloop is not None else ['asyncio']
+
+
+def resolve(name: str = 'auto') -> str:
+    """Map a requested implementation to the one that will be used.
+
+    :raises ValueError: If ``name`` is not one of
+        :data:`LOOP_IMPLEMENTATIONS`.
+    """
+    if name not in LOOP_IMPLEMENTATIONS:
+        raise ValueError(f"Unknown event loop {name!r}, expected one of {LOOP_IMPLEMENTATIONS}")
+    if name == 'asyncio':
+        return 'asyncio'
+    if uvloop is None:
+        if name == 'uvloop':
+            print("uvloop is not installed, using the asyncio event loop")
+        return 'asyncio'
+    return 'uvloop'
+
+
+def new_event_loop(name: str = 'auto') -> asyncio.AbstractEventLoop:
+    """Create a new event loop of the implementation ``name`` resolves to."""
+    if resolve(name) == 'uvloop':
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def loop_name(loop: asyncio.AbstractEventLoop) -> str:
+    """Return the implementation of a running or created loop."""
+    return 'uvloop' if uvloop is not None and isinstance(loop, uvloop.Loop) else 'asyncio'
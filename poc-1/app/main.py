@@ -6,52 +6,259 @@ HTTP peer discovery mechanism has been replaced by the P2P network
 implemented in :mod:`network`.  Nodes now discover one another via
 bootstrap peers and exchange queries over persistent socket
 connections.
+
+By default the network runs on its own event loop in a background
+thread and the HTTP handlers reach it through
+:meth:`network.P2PNetwork.run_threadsafe`.  Setting
+``P2P_SHARED_LOOP=1`` instead starts the network on uvicorn's loop
+from the application's lifespan hook.  ``EVENT_LOOP`` selects the
+event loop implementation of both loops (see :mod:`loops`).
+
+A single process only uses one core for HTTP handling and
+orchestration.  ``P2P_MODE`` splits the node into processes instead:
+
+* ``embedded`` (default) – network and HTTP API in this process.
+* ``daemon`` – only the network, served to HTTP workers on the Unix
+  socket ``P2P_IPC_PATH`` (see :mod:`ipc`).
+* ``worker`` – only the HTTP API, reaching the network through the
+  daemon.  Workers bind port 8000 with ``SO_REUSEPORT``, so several
+  can run side by side and the kernel spreads connections over them.
+* ``split`` – start a daemon and ``HTTP_WORKERS`` workers (one per
+  core by default) as child processes.
 """
 
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator
+import asyncio
+import json
+import multiprocessing
+import multiprocessing.connection
 import os
+import signal
+import socket
+import sys
 import uvicorn
 from orchestrator import orchestrator
+from agent_storer import agent_storer
+from ipc import DEFAULT_PATH, IpcClient, IpcServer
+from loops import LOOP_IMPLEMENTATIONS, new_event_loop, resolve
 from network import P2PNetwork
+from policies import ALL_RESPONSES, CompletionPolicy, FirstResponses
 
 
-app = FastAPI()
-
 # Global reference to the running P2P network instance.  It is
 # initialized in ``main()`` once environment variables are read.
 p2p_network: P2PNetwork | None = None
 
+# When true the network is served on uvicorn's event loop rather than
+# on a loop of its own.
+p2p_shared_loop = False
+
+# In ``worker`` mode the network runs in the daemon process and is
+# reached through this client instead of ``p2p_network``.
+p2p_client: IpcClient | None = None
+
+P2P_MODES = ('embedded', 'daemon', 'worker', 'split')
+
+HTTP_PORT = 8000
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the P2P network on uvicorn's loop when ``p2p_shared_loop`` is set."""
+    task = None
+    if p2p_network is not None and p2p_shared_loop:
+        task = asyncio.create_task(p2p_network.serve())
+    try:
+        yield
+    finally:
+        if task is not None:
+            task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def _completion_policy(quorum: int | None) -> CompletionPolicy:
+    """Map the optional ``quorum`` query parameter to a completion policy."""
+    if quorum is None or quorum < 1:
+        return ALL_RESPONSES
+    return FirstResponses(quorum)
+
+
+async def _peer_query(query: str, quorum: int | None) -> list | None:
+    """Broadcast an owner query to the peers, in process or through the daemon.
+
+    Returns ``None`` if this node runs no network.
+    """
+    if p2p_client is not None:
+        return await p2p_client.query(query, quorum)
+    if p2p_network is not None:
+        # The query runs on the network's loop; its result is handed
+        # back to this handler's loop.
+        return await p2p_network.run_threadsafe(
+            p2p_network.query_peers(query, policy=_completion_policy(quorum)))
+    return None
+
+
+def _peer_stream(query: str, quorum: int | None) -> AsyncIterator[object] | None:
+    """Like :func:`_peer_query`, yielding each peer response as it arrives."""
+    if p2p_client is not None:
+        return p2p_client.stream(query, quorum)
+    if p2p_network is not None:
+        responses = p2p_network.query_peers_stream(query, policy=_completion_policy(quorum))
+        return p2p_network.stream_threadsafe(responses)
+    return None
+
+
+async def _orchestrate_owner_query(query: str) -> object:
+    """Answer an owner query through the orchestrator.
+
+    The orchestrator blocks while the LLM generates.  It runs on a loop
+    of its own in a worker thread so this one, which may also be the P2P
+    network's in shared loop mode, keeps serving peers meanwhile.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None, asyncio.run, orchestrator.orchestrate_request(True, query))
+
+
+async def _publish_content() -> None:
+    """Send the terms of the owner's submissions to the P2P daemon.
+
+    In worker mode they are stored in this process, while the daemon
+    advertises the content filter to the peers.
+    """
+    if p2p_client is None:
+        return
+    try:
+        await p2p_client.set_content(agent_storer.content_terms())
+    except ConnectionError as exc:
+        print(f"Could not send content terms to the P2P daemon: {exc}")
+
 
 @app.get("/internal")
-async def query_internal(query: str):
+async def query_internal(query: str, quorum: int | None = None):
     """Handle a query originating from this node's owner.
 
     The query is first processed locally through the orchestrator and
     then broadcast to any connected peers.  Both the local and remote
     responses are returned in a dictionary.  If no peers are
     connected only the local response will be included under the
-    ``local`` key.
+    ``local`` key.  If ``quorum`` is given, peer responses are returned
+    as soon as that many have arrived.
     """
-    # Local handling via orchestrator.  The orchestrator call may
-    # return a coroutine when integrated with asynchronous LLMs, so
-    # await it accordingly.
-    local_resp = await orchestrator.orchestrate_request(True, query)
+    # Local handling via orchestrator.
+    local_resp = await _orchestrate_owner_query(query)
+    await _publish_content()
 
     # Broadcast to peers if the network is running.
-    peer_responses: list | None = None
-    if p2p_network is not None:
-        # Running this in a separate coroutine on the network's loop
-        # ensures it doesn't block the HTTP handler.
-        peer_responses = await p2p_network.query_peers(query)  # type: ignore[arg-type]
+    try:
+        peer_responses = await _peer_query(query, quorum)
+    except ConnectionError as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
     return {
         "local": local_resp,
         "peers": peer_responses,
     }
 
 
-def main() -> None:
-    """Set up the orchestrator, P2P network and launch the API server."""
-    orchestrator.start()
+@app.get("/internal/agent")
+async def query_agent(address: str, query: str):
+    """Send an owner query to one specific node, located through the DHT.
+
+    Unlike ``/internal`` the query is not flooded; only the node with
+    ``address`` answers.
+    """
+    try:
+        if p2p_client is not None:
+            response = await p2p_client.query_agent(address, query)
+        elif p2p_network is not None:
+            response = await p2p_network.run_threadsafe(p2p_network.query_agent(address, query))
+        else:
+            raise HTTPException(status_code=503, detail="P2P network not running")
+    except LookupError as exc:
+        raise HTTPException(status_code=404, detail=str(exc))
+    except ConnectionError as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+    return {"address": address, "response": response}
+
+
+@app.get("/internal/stream")
+async def query_internal_stream(query: str, quorum: int | None = None):
+    """Handle an owner query, streaming answers as Server-Sent Events.
+
+    The local orchestrator answer and each peer answer are pushed to
+    the client as soon as they are available, as ``local`` and
+    ``peer`` events respectively.  A final ``done`` event marks the end
+    of the stream.  ``quorum`` limits the number of peer answers as
+    for ``/internal``.  If the P2P daemon cannot be reached a
+    ``peer_error`` event is sent instead of peer answers.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def local() -> None:
+        try:
+            result = await _orchestrate_owner_query(query)
+        except Exception as exc:
+            result = {"error": str(exc)}
+        await _publish_content()
+        await events.put(("local", result))
+        await events.put(None)
+
+    async def peers() -> None:
+        try:
+            responses = _peer_stream(query, quorum)
+            if responses is not None:
+                async for response in responses:
+                    await events.put(("peer", response))
+        except ConnectionError as exc:
+            await events.put(("peer_error", {"error": str(exc)}))
+        finally:
+            await events.put(None)
+
+    async def stream():
+        # Start the broadcast first so peers work in parallel with the
+        # local answer.
+        tasks = [asyncio.create_task(peers()), asyncio.create_task(local())]
+        running = len(tasks)
+        try:
+            while running:
+                item = await events.get()
+                if item is None:
+                    running -= 1
+                    continue
+                event, data = item
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        finally:
+            # Stop outstanding work if the client goes away early.
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+async def network_stats():
+    """Return connection and queue statistics for the P2P network."""
+    if p2p_client is not None:
+        try:
+            return await p2p_client.stats()
+        except ConnectionError as exc:
+            raise HTTPException(status_code=503, detail=str(exc))
+    if p2p_network is None:
+        return {}
+
+    async def snapshot():
+        return p2p_network.stats()
+
+    return await p2p_network.run_threadsafe(snapshot())
+
+
+def _create_network(event_loop: str) -> P2PNetwork:
+    """Create the P2P network configured by the environment."""
     # Read P2P configuration from environment variables.  A default
     # port of 9000 is used if ``P2P_PORT`` is not set.  The
     # ``BOOTSTRAP_PEERS`` variable should contain a comma separated
@@ -65,26 +272,209 @@ def main() -> None:
     bootstrap_peers: list[str] = []
     if bootstrap_csv:
         bootstrap_peers = [p.strip() for p in bootstrap_csv.split(',') if p.strip()]
+    # ``SEND_QUEUE_SIZE`` bounds each peer's outbound queue and
+    # ``SEND_QUEUE_POLICY`` selects what happens when it overflows.
+    try:
+        send_queue_size = int(os.environ.get('SEND_QUEUE_SIZE', '1000'))
+    except ValueError:
+        send_queue_size = 1000
+    send_queue_policy = os.environ.get('SEND_QUEUE_POLICY', 'drop_oldest')
+    # ``QUERY_TTL`` is the number of hops queries from this node travel.
+    try:
+        query_ttl = int(os.environ.get('QUERY_TTL', '3'))
+    except ValueError:
+        query_ttl = 3
+    # ``CALLBACK_WORKERS`` caps how many peer queries are answered by
+    # the orchestrator at the same time.
+    try:
+        callback_workers = int(os.environ.get('CALLBACK_WORKERS', '4'))
+    except ValueError:
+        callback_workers = 4
+    # ``MAX_INFLIGHT_PER_PEER`` caps how many queries from one peer are
+    # answered at the same time.  Raise it on nodes whose neighbours
+    # send bursts of owner queries.
+    try:
+        max_inflight_per_peer = int(os.environ.get('MAX_INFLIGHT_PER_PEER', '8'))
+    except ValueError:
+        max_inflight_per_peer = 8
+    # ``TARGET_OUTBOUND`` is the number of outbound connections the
+    # node keeps open to peers learned through peer exchange.
+    try:
+        target_outbound = int(os.environ.get('TARGET_OUTBOUND', '8'))
+    except ValueError:
+        target_outbound = 8
+    # ``PEER_QUERY_RATE`` and ``QUERY_RATE`` are the queries per second
+    # accepted from each peer and from all peers together; 0 disables
+    # the limit.
+    try:
+        peer_query_rate: float | None = float(os.environ.get('PEER_QUERY_RATE', '5')) or None
+    except ValueError:
+        peer_query_rate = 5.0
+    try:
+        query_rate: float | None = float(os.environ.get('QUERY_RATE', '50')) or None
+    except ValueError:
+        query_rate = 50.0
+    # ``MAX_INBOUND`` and ``MAX_OUTBOUND`` cap the number of peer
+    # connections in each direction.
+    try:
+        max_inbound = int(os.environ.get('MAX_INBOUND', '64'))
+    except ValueError:
+        max_inbound = 64
+    try:
+        max_outbound = int(os.environ.get('MAX_OUTBOUND', '16'))
+    except ValueError:
+        max_outbound = 16
+    # ``QUERY_FANOUT`` limits how many peers each query is sent or
+    # forwarded to; unset or 0 floods to all peers.
+    try:
+        query_fanout = int(os.environ.get('QUERY_FANOUT', '0')) or None
+    except ValueError:
+        query_fanout = None
+    # ``COMPRESS_THRESHOLD`` is the smallest frame, in bytes, that is
+    # compressed on the wire; a negative value disables compression.
+    try:
+        compress_threshold: int | None = int(os.environ.get('COMPRESS_THRESHOLD', '512'))
+    except ValueError:
+        compress_threshold = 512
+    if compress_threshold is not None and compress_threshold < 0:
+        compress_threshold = None
 
-    # Define a simple wrapper around the orchestrator call.  When
-    # broadcasting queries to peers we want to synchronously call
-    # orchestrator from the network's loop; if the orchestrator ever
-    # returns a coroutine this wrapper will await it.  Passing the
-    # wrapper avoids tight coupling between the network and the
-    # orchestrator implementation.
+    # Define a simple wrapper around the orchestrator call.  The
+    # network runs it on one of its worker threads, so the blocking
+    # LLM call inside does not stall the network loop; the coroutine
+    # returned by the orchestrator is run to completion there.
+    # Passing the wrapper avoids tight coupling between the network
+    # and the orchestrator implementation.  Peer queries come from
+    # outside this node, so they take the orchestrator's external path
+    # and never reach the owner's agents such as the storer.
     def on_query(query: str):
-        resp = orchestrator.orchestrate_request(True, query)
+        resp = orchestrator.orchestrate_request(False, query)
         return resp
 
+    return P2PNetwork(p2p_port, bootstrap_peers, on_query,  # type: ignore
+                      max_send_queue=send_queue_size, overflow_policy=send_queue_policy,
+                      default_ttl=query_ttl, callback_workers=callback_workers,
+                      max_inflight_per_peer=max_inflight_per_peer,
+                      peer_query_rate=peer_query_rate, query_rate=query_rate,
+                      target_outbound=target_outbound, max_inbound=max_inbound,
+                      max_outbound=max_outbound,
+                      content_terms=agent_storer.content_terms, fanout=query_fanout,
+                      compress_threshold=compress_threshold, event_loop=event_loop)
+
+
+def _serve_http(event_loop: str, reuse_port: bool = False) -> None:
+    """Run the API server on ``HTTP_PORT``.
+
+    With ``reuse_port`` the listening socket is opened with
+    ``SO_REUSEPORT`` so that several worker processes can bind the
+    same port.
+    """
+    if not reuse_port:
+        uvicorn.run(app, host="0.0.0.0", port=HTTP_PORT, loop=resolve(event_loop))
+        return
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("0.0.0.0", HTTP_PORT))
+    uvicorn.Server(uvicorn.Config(app, loop=resolve(event_loop))).run(sockets=[sock])
+
+
+def _run_daemon(network: P2PNetwork, ipc_path: str, event_loop: str) -> None:
+    """Run the network and its IPC endpoint on this thread until the process exits.
+
+    Owner submissions arrive in the workers, so the network advertises
+    the content terms they report.
+    """
+    server = IpcServer(network, ipc_path)
+    network.content_terms = server.content_terms
+
+    async def serve() -> None:
+        await asyncio.gather(network.serve(), server.serve())
+
+    new_event_loop(event_loop).run_until_complete(serve())
+
+
+def _run_mode(mode: str) -> None:
+    """Entry point of the child processes started in ``split`` mode."""
+    os.environ['P2P_MODE'] = mode
+    main()
+
+
+def _run_split(workers: int) -> None:
+    """Run a P2P daemon and ``workers`` HTTP workers as child processes.
+
+    If any of them exits the others are stopped too, so that whatever
+    supervises this process notices and restarts the node.  Stopping
+    this process, e.g. with ``docker stop``, stops the children.
+    """
+    processes = [multiprocessing.Process(target=_run_mode, args=('daemon',), name='p2p-daemon')]
+    processes += [multiprocessing.Process(target=_run_mode, args=('worker',), name=f'http-worker-{i}')
+                  for i in range(workers)]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    for process in processes:
+        process.start()
+    try:
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+
+def main() -> None:
+    """Set up the orchestrator, P2P network and launch the API server."""
+    # ``P2P_MODE`` selects which parts of the node run in this process
+    # and ``P2P_IPC_PATH`` the socket daemon and workers share.
+    mode = os.environ.get('P2P_MODE', 'embedded')
+    if mode not in P2P_MODES:
+        mode = 'embedded'
+    ipc_path = os.environ.get('P2P_IPC_PATH', DEFAULT_PATH)
+    # ``EVENT_LOOP`` is ``auto``, ``uvloop`` or ``asyncio``; ``auto``
+    # uses uvloop when it is installed.
+    event_loop = os.environ.get('EVENT_LOOP', 'auto')
+    if event_loop not in LOOP_IMPLEMENTATIONS:
+        event_loop = 'auto'
+
+    if mode == 'split':
+        # ``HTTP_WORKERS`` is the number of HTTP worker processes.
+        try:
+            workers = int(os.environ.get('HTTP_WORKERS', str(os.cpu_count() or 1)))
+        except ValueError:
+            workers = os.cpu_count() or 1
+        print(f"Starting P2P daemon and {workers} HTTP workers")
+        _run_split(max(1, workers))
+        return
+
+    orchestrator.start()
+    if mode == 'worker':
+        global p2p_client
+        p2p_client = IpcClient(ipc_path)
+        print(f"HTTP worker {os.getpid()} listening on port {HTTP_PORT}, P2P daemon at {ipc_path}")
+        _serve_http(event_loop, reuse_port=True)
+        return
+
+    if mode == 'daemon':
+        network = _create_network(event_loop)
+        print(f"P2P daemon on port {network.port}, serving workers at {ipc_path}")
+        _run_daemon(network, ipc_path, event_loop)
+        return
+
+    # ``P2P_SHARED_LOOP`` runs the network on uvicorn's loop.
+    global p2p_shared_loop
+    p2p_shared_loop = os.environ.get('P2P_SHARED_LOOP', '') in ('1', 'true', 'yes')
     # Instantiate and start the P2P network.  Store it in the module
-    # level variable so the HTTP handlers can reference it.
+    # level variable so the HTTP handlers can reference it.  In shared
+    # loop mode the lifespan hook starts it instead.
     global p2p_network
-    p2p_network = P2PNetwork(p2p_port, bootstrap_peers, on_query)  # type: ignore
-    p2p_network.start()
+    p2p_network = _create_network(event_loop)
+    if not p2p_shared_loop:
+        p2p_network.start()
 
     # Log startup information.
-    print(f"HTTP API listening on port 8000, P2P port {p2p_port}")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    print(f"HTTP API listening on port {HTTP_PORT}, P2P port {p2p_network.port}")
+    _serve_http(event_loop)
 
 
 if __name__ == "__main__":
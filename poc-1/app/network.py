@@ -11,30 +11,167 @@ bootstrap peers and perform a simple handshake consisting of a
 ``version`` message and a ``verack`` acknowledgement, similar to the
 version/verack handshake described in Bitcoin【741702894021493†L867-L878】.
 
-After the handshake has completed a bidirectional JSON based message
-protocol is used on top of a plain TCP socket.  Messages are encoded
-as newline separated JSON objects with a ``type`` field.  The two
-primary application level messages are:
+After the handshake has completed a bidirectional message protocol is
+used on top of a plain TCP socket.  The handshake itself is always
+newline separated JSON; each side lists the encodings it supports in
+its ``version`` message and both switch to the negotiated one after
+``verack`` (see :mod:`wire`).  Compression of large frames is
+negotiated the same way from a ``compression`` list.  Every message is an object with a
+``type`` field.  The two primary application level messages are:
 
 * ``query`` – broadcast by a node that wishes to ask all of its peers
   to process a query.  It carries a unique UUID in the ``id`` field,
   an ``origin`` address identifying the original requester and the
-  query text itself.  Nodes forward unknown queries to all peers
-  except the one they received the message from and send back a
-  ``response``.
+  query text itself.  A ``ttl`` field limits how many hops the query
+  travels: nodes forward unknown queries with ``ttl`` decremented to
+  all peers except the one they received the message from, stop
+  forwarding once it reaches one, and send back a ``response``.
+  Queries without a ``ttl`` are treated as carrying the receiving
+  node's default.
 * ``response`` – carries the original query ``id`` along with the
   replying node's ``from`` address and the result of locally
   processing the query.
 
+Responses travel back along the path the query took.  Every node that
+forwards a query remembers which peer it came from and relays replies
+for that ``id`` to that peer until they reach the origin.  Because
+the origin cannot know in advance how many nodes a query will reach,
+two small replies keep its count of outstanding answers exact:
+
+* ``ack`` – sent upstream by a node that forwarded a query, before any
+  downstream reply can arrive, with the number of peers it
+  ``forwarded`` the query to.  The origin expects that many extra
+  replies.
+* ``dup`` – sent by a node that receives a query it has already seen
+  instead of a ``response``.  It accounts for the delivery without
+  carrying an answer.
+* ``busy`` – sent instead of processing a query when the node is
+  already working on as many queries from that peer as it allows, or
+  when the peer, or all peers together, exceed the node's query rate
+  limits (see :mod:`ratelimit`).  Like ``dup`` it accounts for the
+  delivery without an answer.
+
+When the origin stops waiting before every reply has arrived, for
+example because its completion policy (see :mod:`policies`) is
+satisfied, it sends a ``cancel`` for the query ``id`` to the peers it
+queried.  Nodes pass a ``cancel`` from the peer a query came from on
+to the peers they forwarded it to and drop their own pending work for
+it.
+
+Nodes learn about each other through peer exchange.  Every node keeps
+a :class:`peer_table.PeerTable` of known listening addresses, seeded
+from its bootstrap peers and from the address an inbound peer
+announces in its ``version`` message.  Two messages spread it:
+
+* ``getaddr`` – sent once on every outbound connection to ask the peer
+  for addresses it knows.
+* ``addr`` – carries a list of ``[host, port]`` pairs, either as the
+  reply to ``getaddr`` or unsolicited when a node learns of a new
+  address.  Small ``addr`` messages with previously unknown entries are
+  relayed to a couple of random peers so fresh nodes become known
+  quickly.
+
+A connection manager periodically dials addresses chosen by the table
+until the node has ``target_outbound`` outbound connections, so a mesh
+assembles itself from a few bootstrap entries.  Bootstrap peers, and
+outbound peers whose connection drops, are additionally watched by a
+reconnect supervisor which redials them with jittered exponential
+backoff (see :mod:`reconnect`), so nodes that start before their
+bootstrap peers listen still join the mesh.
+
+Connections are admitted within limits so that a misbehaving client
+cannot exhaust file descriptors or memory.  Inbound handshakes run at
+most ``max_inbound`` at a time and must complete within
+``handshake_timeout`` seconds.  When an inbound handshake completes
+while ``max_inbound`` inbound peers are already connected, the lowest
+scored inbound peer is evicted to make room, as Bitcoin Core does: the
+peers with the lowest round trip time and those that most recently
+delivered answers are protected, then among the peers of the most
+common network group the one that delivered the fewest answers, the
+youngest on ties, goes.  If every peer is protected the new connection
+is refused instead.  Outbound peers are chosen by this node and never
+evicted; a new outbound connection is refused while ``max_outbound``
+are open.  Bootstrap peers are never evicted, and evicted peers are
+not redialled.
+
+Connections are kept honest with ``ping`` and ``pong`` messages.  Every
+``ping_interval`` seconds a node sends each peer a ``ping`` with a
+random ``nonce`` which the peer echoes in a ``pong``.  The round trip
+feeds a smoothed RTT estimate per peer (see :mod:`latency`); a peer
+that leaves a ``ping`` unanswered for ``ping_timeout`` seconds is
+considered dead and disconnected.  Replies a pending query still
+expected through a peer that disconnects are written off at once
+instead of holding the query until its timeout.  A forwarding node
+does the same for the queries it relayed to the lost peer: it sends
+the node the query came from one ``dup`` per reply still expected
+through that peer.
+
+The node also records how long answers take to arrive through each
+peer.  Unless told otherwise, :meth:`P2PNetwork.query_peers` stops
+waiting once the slowest queried peer's usual answer time (its p95
+plus a margin) has passed instead of always waiting for the full
+timeout, which then only acts as a ceiling.
+
+A query may also be sent to only the ``max_peers`` fastest peers and
+*hedged*: if one of them has not answered within its usual p90, the
+same query (same ``id``) is sent to a peer that was not queried yet.
+Whichever of the two answers first is kept and the other is
+cancelled.  Only queries sent with a ``ttl`` of 1 are hedged: further
+out, answers relayed through a peer are not that peer's own, and
+cancelling it would drop every answer in its subtree.
+
+Queries are only sent to peers that may be able to answer them.  A
+node given a ``content_terms`` callback advertises a Bloom filter of
+the terms in its hosted content (see :mod:`content`), base64 encoded,
+in a ``filter`` message sent right after the handshake and again
+whenever its content changes.  It is not part of ``version``: the
+handshake travels as JSON lines, which cannot carry a large filter,
+while the ``filter`` message uses the negotiated framed codec.  A filter only
+describes its own node, not the nodes behind it, so it is applied on
+the last hop alone: when a query is sent with a ``ttl`` of 1, by the
+origin or by a forwarding node, peers whose filter contains none of
+its terms are skipped.  With hops left the query still goes to every
+peer, as those may relay it to nodes that match.  Peers that
+advertise no filter, for example because they host nothing yet,
+receive every query.
+
+On dense meshes flooding every query to every neighbour is wasteful.
+With ``fanout`` set a node instead sends each query, its own or one
+it forwards, to at most ``fanout`` of the eligible peers, chosen at
+random or weighted towards peers that answer quickly.  Together with
+the ``ttl`` hop limit this spreads queries epidemically; operators
+trade recall for bandwidth and CPU by choosing the fanout (see the
+``gossip`` benchmark in :mod:`bench`).
+
+Besides flooding, nodes can be reached directly.  Node addresses double
+as 160‑bit IDs in a Kademlia routing table (see :mod:`dht`) and two
+further messages implement remote procedure calls on top of peer
+connections:
+
+* ``rpc`` – a request with a random ``rpc_id`` and a ``method``:
+  ``find_node`` returns the contacts closest to a ``target`` ID,
+  ``find_value`` returns the ``value`` stored under a ``key`` or else
+  the closest contacts, ``store`` stores a ``value`` under a ``key``
+  and ``query`` runs the callback on a ``payload``.
+* ``rpc_reply`` – the answer, carrying the request's ``rpc_id``.
+
+:meth:`P2PNetwork.find_node`, :meth:`P2PNetwork.find_value` and
+:meth:`P2PNetwork.store` perform iterative lookups and
+:meth:`P2PNetwork.query_agent` sends a query to one specific node.
+Contacts that are not peers are reached over short-lived connections
+whose ``version`` message carries ``rpc_only``: neither side registers
+them as peers, floods queries over them or counts them against the
+peer limits, and the dialling node closes them once the reply arrived.
+At most ``max_inbound`` such connections are accepted at a time.
+
 The ``P2PNetwork`` class encapsulates all networking concerns.  It
 spawns its own ``asyncio`` event loop in a background thread to avoid
 blocking the FastAPI server.  Each peer connection is handled by an
 asynchronous task that reads and writes JSON messages.  When a query
-is broadcast the initiator registers an aggregator entry in
-``self.pending_queries`` containing a list of responses and an
-``asyncio.Event``.  As response messages arrive the aggregator is
-updated and the event is set once all peers have replied or a
-timeout occurs.
+is broadcast the initiator registers a :class:`PendingQuery` in
+``self.pending_queries``.  As replies arrive the aggregator is updated
+and each response is handed to the caller; the query completes once
+every node the query reached has replied or a timeout occurs.
 
 To integrate the network with the rest of the application simply
 instantiate ``P2PNetwork`` with a port, an optional list of bootstrap
@@ -42,27 +179,425 @@ peers and a callback.  The callback should accept a query string and
 return the local node's response.  When running in production the
 callback will likely wrap the orchestrator's call into the LLAMA
 pipeline; during development and testing it can be a simple function
-that returns a fixed string.  Once started the network runs until the
-Python process exits.
+that returns a fixed string.  LLM calls block for seconds, so by
+default the callback runs on a bounded pool of worker threads and the
+network loop keeps reading, forwarding and handshaking while answers
+are being produced.  Once started the network runs until the Python
+process exits.
+
+All of the network's state belongs to its event loop.  Code running
+on another loop, such as a FastAPI request handler, must not await
+the network's coroutines directly; it goes through
+:meth:`P2PNetwork.run_threadsafe` and
+:meth:`P2PNetwork.stream_threadsafe` instead, which schedule the work
+on the network loop and hand the results back.  Alternatively
+:meth:`P2PNetwork.serve` runs the network on the caller's loop, in
+which case those helpers simply await directly.
 
 Note: this implementation focuses on demonstrating the underlying
 network mechanics.  It is **not** a full implementation of the
 Bitcoin protocol.  Keys are generated from random bytes instead of a
 secp256k1 ECDSA key pair, address derivation is simplified and
-messages are exchanged using JSON instead of Bitcoin's binary wire
-format.  Nonetheless the major concepts of handshake, peer discovery,
+messages are exchanged using JSON or MessagePack instead of Bitcoin's
+binary wire format.  Nonetheless the major concepts of handshake, peer discovery,
 unique node identifiers and query propagation are preserved【761311005096124†L350-L399】.
 """
 
 from __future__ import annotations
 
 import asyncio
-import json
+import base64
+import collections
+import concurrent.futures
+import random
 import threading
 import uuid
 import hashlib
 import secrets
-from typing import Callable, Dict, List, Optional, Tuple
+import time
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
+
+from bloom import BloomFilter
+from content import build_filter, matches, terms
+from dedup import DedupCache
+from dht import ALPHA, K, Contact, RoutingTable, key_id, node_id
+from expiring import ExpiringDict
+from latency import LatencyHistogram, RttEstimator
+from loops import loop_name, new_event_loop
+from peer_table import Address, PeerTable, network_group
+from policies import ALL_RESPONSES, CompletionPolicy
+from ratelimit import RateLimiter
+from reconnect import BACKOFF, CONNECTED, IDLE, DialState
+from wire import JSONL, Codec, available_codecs, available_compressors, negotiate, negotiate_compression
+
+
+T = TypeVar('T')
+
+# How ``on_query`` is run.  ``executor`` calls it on a worker pool so
+# blocking callbacks do not stall the network loop; ``async`` awaits it
+# on the loop and is only suitable for callbacks that never block.
+CALLBACK_MODES = ('executor', 'async')
+
+# Overflow policies for a peer's outbound queue.  ``drop_oldest``
+# discards the oldest queued message, ``drop_query`` sacrifices queued
+# or new ``query`` messages so that responses and other control
+# traffic still get through and ``disconnect`` drops the peer.
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_query', 'disconnect')
+
+# How peers are picked when a query goes to a subset of size
+# ``fanout``.  ``random`` picks uniformly; ``weighted`` prefers peers
+# whose answers usually arrive quickly.
+FANOUT_MODES = ('random', 'weighted')
+
+# Peer exchange limits, as in Bitcoin.  An ``addr`` message carries at
+# most MAX_ADDR_SEND entries; messages of up to ADDR_RELAY_MAX entries
+# are relayed to ADDR_RELAY_FANOUT random peers.
+MAX_ADDR_SEND = 1000
+ADDR_RELAY_MAX = 10
+ADDR_RELAY_FANOUT = 2
+
+# Answers needed from a peer before its own latency histogram is used
+# for adaptive timeouts; until then the histogram of all peers is.
+ADAPTIVE_MIN_SAMPLES = 20
+
+# Largest content filter accepted from a peer, in bytes.
+MAX_FILTER_BYTES = 1 << 20
+
+# Largest DHT entry, key and value encoded as JSON, a node stores for
+# others.  Entries point at agents; they are not meant to hold content.
+MAX_DHT_VALUE_BYTES = 4096
+
+# Peers protected from eviction when the connection limit is reached:
+# the ones with the lowest round trip time and the ones that most
+# recently delivered answers.
+EVICT_PROTECT_FAST = 4
+EVICT_PROTECT_USEFUL = 4
+
+
+class PeerConnection:
+    """An established connection to a peer.
+
+    Holds the stream pair together with the codec negotiated during
+    the handshake so that every message sent to or read from the peer
+    uses the same encoding.
+
+    Outbound messages never touch the stream writer directly.  They
+    are encoded and appended to a bounded queue which a dedicated
+    writer task drains, so a peer that reads slowly only ever delays
+    its own traffic.  When the queue is full ``overflow_policy``
+    decides what gives way.  If the peer does not accept a message
+    within ``send_timeout`` seconds it is considered stalled and the
+    connection is aborted.
+
+    The writer task coalesces: it takes every message queued by the
+    time it runs, up to ``max_batch_bytes``, and hands them to the
+    socket in one write and one drain.  Bursts, such as a query being
+    forwarded or answers being relayed, then cost a single syscall.
+    With a positive ``batch_delay`` the task additionally waits that
+    long for more messages when the batch is not yet full, trading
+    latency for fewer writes.
+
+    :param address: The peer's node address.
+    :param reader: Stream reader for the connection.
+    :param writer: Stream writer for the connection.
+    :param codec: The negotiated wire codec.
+    :param outbound: ``True`` if this node opened the connection.
+    :param max_queue: Maximum number of messages waiting to be written.
+    :param overflow_policy: One of :data:`OVERFLOW_POLICIES`.
+    :param send_timeout: Seconds a single write may take to drain.
+    :param max_batch_bytes: Upper bound of a coalesced write.  A
+        single larger message is still written on its own.
+    :param batch_delay: Seconds to wait for more messages before a
+        write that is below ``max_batch_bytes``.
+    """
+
+    def __init__(self, address: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 codec: Codec, outbound: bool, max_queue: int = 1000,
+                 overflow_policy: str = 'drop_oldest', send_timeout: float = 2.0,
+                 max_batch_bytes: int = 65536, batch_delay: float = 0.0):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.codec = codec
+        self.outbound = outbound
+        peername = writer.get_extra_info('peername')
+        self.remote_host: Optional[str] = peername[0] if peername else None
+        # Address the peer accepts connections on, if known.
+        self.listen_addr: Optional[Address] = None
+        self.getaddr_answered = False
+        # Bloom filter of the peer's content terms, if it sent one.
+        self.content_filter: Optional[BloomFilter] = None
+        # Keepalive state: round trip estimate, the outstanding ping
+        # and when we last sent one.
+        self.rtt = RttEstimator()
+        self.ping_nonce: Optional[int] = None
+        self.ping_sent_at = 0.0
+        # Usefulness, used to pick a peer to evict: answers received
+        # through the peer and when the last one arrived.
+        self.connected_at = time.monotonic()
+        self.answers = 0
+        self.last_answer = 0.0
+        # Set when the node closed the connection to make room for
+        # another, so it is not handed to the reconnect supervisor.
+        self.evicted = False
+        # Rate limits on queries from the peer.
+        self.query_limiter = RateLimiter()
+        # Set for short-lived DHT connections that are not peers.
+        self.rpc_only = False
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.max_batch_bytes = max_batch_bytes
+        self.batch_delay = batch_delay
+
+        # Queued (message type, encoded bytes) pairs awaiting the writer task.
+        self._queue: Deque[Tuple[str, bytes]] = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+        self.closed = False
+
+        # Tasks answering queries received from this peer.
+        self.inflight: Set[asyncio.Task] = set()
+
+        # Counters reported by ``stats``.
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.writes = 0
+        self.messages_dropped = 0
+        self.queue_high_water = 0
+        self.busy_replies = 0
+
+    def start(self) -> None:
+        """Spawn the writer task.  Must be called on the network loop."""
+        self._writer_task = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def send(self, message: Dict[str, object]) -> bool:
+        """Queue a message for delivery without blocking.
+
+        :returns: ``True`` if the message was queued, ``False`` if it
+            was dropped because of the overflow policy or because the
+            connection is closed.
+        """
+        if self.closed:
+            return False
+        mtype = str(message.get('type'))
+        item = (mtype, self.codec.encode(message))
+        if len(self._queue) >= self.max_queue and not self._make_room(mtype):
+            self.messages_dropped += 1
+            return False
+        self._queue.append(item)
+        self.queue_high_water = max(self.queue_high_water, len(self._queue))
+        self._wakeup.set()
+        return True
+
+    def close(self) -> None:
+        """Abort the connection and stop the writer task.
+
+        The peer's reader notices the closed transport and performs
+        the usual disconnect clean up.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.messages_dropped += len(self._queue)
+        self._queue.clear()
+        if self._writer_task is not None and self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()
+        # Nobody is left to receive the answers.
+        for task in list(self.inflight):
+            task.cancel()
+        self.writer.transport.abort()
+
+    def stats(self) -> Dict[str, object]:
+        """Return queue and traffic counters for this connection."""
+        return {
+            'direction': 'outbound' if self.outbound else 'inbound',
+            'codec': self.codec.name,
+            'queue_depth': len(self._queue),
+            'queue_high_water': self.queue_high_water,
+            'messages_sent': self.messages_sent,
+            'bytes_sent': self.bytes_sent,
+            'writes': self.writes,
+            'messages_per_write': self.messages_sent / self.writes if self.writes else 0.0,
+            'messages_dropped': self.messages_dropped,
+            'inflight_queries': len(self.inflight),
+            'busy_replies': self.busy_replies,
+            'rate_limit': self.query_limiter.stats(),
+            'answers': self.answers,
+            'connected_for': time.monotonic() - self.connected_at,
+            'rtt': self.rtt.stats(),
+            'compression': self.codec.stats(),
+        }
+
+    def _make_room(self, mtype: str) -> bool:
+        """Apply the overflow policy to a full queue.
+
+        :returns: ``True`` if a message of type ``mtype`` may now be
+            appended.
+        """
+        if self.overflow_policy == 'disconnect':
+            print(f"Send queue to peer {self.address} overflowed, disconnecting")
+            self.close()
+            return False
+        if self.overflow_policy == 'drop_query':
+            if mtype == 'query':
+                return False
+            for index, (queued_type, _) in enumerate(self._queue):
+                if queued_type == 'query':
+                    del self._queue[index]
+                    self.messages_dropped += 1
+                    return True
+            return False
+        # drop_oldest
+        self._queue.popleft()
+        self.messages_dropped += 1
+        return True
+
+    def _take_batch(self) -> List[bytes]:
+        """Pop queued messages for one write, at least one and at most ``max_batch_bytes``."""
+        batch: List[bytes] = []
+        size = 0
+        while self._queue:
+            data = self._queue[0][1]
+            if batch and size + len(data) > self.max_batch_bytes:
+                break
+            self._queue.popleft()
+            batch.append(data)
+            size += len(data)
+        return batch
+
+    async def _write_loop(self) -> None:
+        """Drain the outbound queue into the socket."""
+        try:
+            while not self.closed:
+                if not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                if self.batch_delay > 0 and sum(len(data) for _, data in self._queue) < self.max_batch_bytes:
+                    await asyncio.sleep(self.batch_delay)
+                    if not self._queue:
+                        continue
+                batch = self._take_batch()
+                self.writer.write(batch[0] if len(batch) == 1 else b''.join(batch))
+                await asyncio.wait_for(self.writer.drain(), self.send_timeout)
+                self.writes += 1
+                self.messages_sent += len(batch)
+                self.bytes_sent += sum(len(data) for data in batch)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            print(f"Peer {self.address} stopped reading, disconnecting")
+            self.close()
+        except Exception as exc:
+            print(f"Error writing to peer {self.address}: {exc}")
+            self.close()
+
+
+def _invoke_callback(callback: Callable[[str], object], query: str) -> object:
+    """Call ``callback`` on a worker, running it to completion if it is async.
+
+    Defined at module level so that it can be pickled for process pools.
+    """
+    result = callback(query)
+    if asyncio.iscoroutine(result):
+        result = asyncio.run(result)
+    return result
+
+
+def _storable(key: str, value: object) -> bool:
+    """Return ``True`` if a DHT entry is plain JSON within :data:`MAX_DHT_VALUE_BYTES`."""
+    try:
+        return len(JSONL.encode({'key': key, 'value': value})) <= MAX_DHT_VALUE_BYTES
+    except (TypeError, ValueError):
+        return False
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """Return the event loop running in this thread, if any."""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class PendingQuery:
+    """Aggregator for a query this node originated.
+
+    Counts the replies still expected and hands every response to the
+    consumer as soon as it arrives.  Replies are also counted per
+    direct peer they arrive through, so that those still expected
+    through a peer that disconnects can be written off.
+
+    :param query_id: The query's UUID.
+    :param expected: Number of replies initially expected.
+    """
+
+    # Queued after the last response once no more replies are expected.
+    DONE = object()
+
+    def __init__(self, query_id: str, expected: int):
+        self.id = query_id
+        self.remaining = expected
+        self.responses: List[object] = []
+        # Addresses of the peers the query was sent to, and the number
+        # of replies still expected through each of them.
+        self.targets: List[str] = []
+        self.outstanding: Dict[str, int] = {}
+        self.started = time.monotonic()
+        # The query message, kept for hedging, and the peers that
+        # delivered at least one answer.
+        self.message: Dict[str, object] = {}
+        self.answered: Set[str] = set()
+        self.query_terms: Set[str] = set()
+        # Hedging state: each hedged peer and its hedge point at each
+        # other until one of them answers; the other is superseded and
+        # its replies are ignored.
+        self.rivals: Dict[str, str] = {}
+        self.hedge_peers: Set[str] = set()
+        self.superseded: Set[str] = set()
+        self.done = asyncio.Event()
+        self._arrivals: asyncio.Queue = asyncio.Queue()
+        self._check_done()
+
+    def expect(self, count: int, via: Optional[str] = None) -> None:
+        """Wait for ``count`` more replies, e.g. after a downstream ``ack``.
+
+        :param via: The direct peer the replies will arrive through.
+        """
+        self.remaining += count
+        if via is not None:
+            self.outstanding[via] = self.outstanding.get(via, 0) + count
+
+    def add_response(self, response: object, via: Optional[str] = None) -> None:
+        """Record a response and count it as a reply."""
+        self.responses.append(response)
+        self._arrivals.put_nowait(response)
+        if via is not None:
+            self.answered.add(via)
+        self.resolve(via=via)
+
+    def resolve(self, count: int = 1, via: Optional[str] = None) -> None:
+        """Count ``count`` replies that carry no answer (``dup``, failed sends)."""
+        self.remaining -= count
+        if via is not None and via in self.outstanding:
+            self.outstanding[via] = max(0, self.outstanding[via] - count)
+        self._check_done()
+
+    def peer_lost(self, peer_id: str) -> None:
+        """Write off the replies still expected through ``peer_id``."""
+        count = self.outstanding.pop(peer_id, 0)
+        if count:
+            self.resolve(count)
+
+    async def next_arrival(self) -> object:
+        """Return the next response, or :attr:`DONE` once all have arrived."""
+        return await self._arrivals.get()
+
+    def _check_done(self) -> None:
+        if self.remaining <= 0 and not self.done.is_set():
+            self.done.set()
+            self._arrivals.put_nowait(self.DONE)
 
 
 class P2PNetwork:
@@ -70,7 +605,7 @@ class P2PNetwork:
 
     Instances of this class manage a TCP server, connect to known
     peers, perform a version/verack handshake and then exchange
-    newline‑delimited JSON messages.  Queries may be broadcast to all
+    messages using the negotiated wire codec.  Queries may be broadcast to all
     connected peers and responses are collected and returned to the
     caller.
 
@@ -82,33 +617,278 @@ class P2PNetwork:
         new query.  It is passed the query string and should return a
         result.  If the callback returns a coroutine it will be
         awaited automatically.
+    :param send_timeout: Maximum number of seconds a single peer may
+        take to accept a message.  Peers that miss the deadline are
+        considered stalled and disconnected.
+    :param max_send_queue: Maximum number of messages queued for a
+        single peer before ``overflow_policy`` applies.
+    :param write_batch_bytes: Most bytes of queued messages coalesced
+        into one socket write.
+    :param write_batch_delay: Seconds a peer's writer waits for more
+        messages before a write below ``write_batch_bytes``; ``0``
+        only coalesces what is already queued.
+    :param overflow_policy: What to do when a peer's send queue is
+        full; one of :data:`OVERFLOW_POLICIES`.
+    :param dedup_capacity: Number of query IDs remembered per
+        generation of the duplicate filter.
+    :param dedup_ttl: Seconds a query ID is remembered for (at least).
+    :param default_ttl: Hop limit given to queries this node originates
+        and assumed for received queries that carry none.  A ``ttl``
+        of one reaches direct peers only.
+    :param max_ttl: Upper bound applied to the ``ttl`` of received
+        queries so a peer cannot make a query flood the whole mesh.
+    :param route_ttl: Seconds this node keeps relaying replies for a
+        query it forwarded.  Up to ``dedup_capacity`` routes are kept.
+    :param callback_mode: How ``on_query`` is run; one of
+        :data:`CALLBACK_MODES`.
+    :param callback_workers: Maximum number of ``on_query`` calls in
+        progress at once.  Further queries wait for a free slot.
+    :param callback_executor: Executor used in ``executor`` mode.  By
+        default a thread pool with ``callback_workers`` threads is
+        created.  A :class:`concurrent.futures.ProcessPoolExecutor`
+        may be passed if ``on_query`` can be pickled.
+    :param max_inflight_per_peer: Maximum number of queries from a
+        single peer being answered at once.  Further queries from that
+        peer are turned away with ``busy``.  This includes the peer's
+        own queries: a node whose owner sends a burst of more than this
+        many concurrent queries gets only this many answers from each
+        neighbour, the rest counting as ``busy``.
+    :param peer_query_rate: Queries per second accepted from a single
+        peer, with bursts of up to ``peer_query_burst``.  Queries over
+        the limit are turned away with ``busy``.  ``None`` disables
+        the limit, as for the other rates.
+    :param peer_byte_rate: Bytes of query text per second accepted
+        from a single peer, with bursts of up to ``peer_byte_burst``.
+    :param query_rate: Queries per second accepted from all peers
+        together, with bursts of up to ``query_burst``.
+    :param byte_rate: Bytes of query text per second accepted from all
+        peers together, with bursts of up to ``byte_burst``.
+    :param target_outbound: Number of outbound connections the
+        connection manager keeps open.
+    :param max_inbound: Most inbound peers, and most inbound handshakes
+        in progress, at any time.
+    :param max_outbound: Most outbound peers, including bootstrap and
+        reconnected peers.  Outbound connections beyond it are refused
+        rather than evicting a peer.
+    :param handshake_timeout: Seconds an inbound connection may take to
+        complete the handshake.
+    :param connect_interval: Seconds between connection manager rounds.
+    :param connect_timeout: Seconds allowed for dialling a peer and
+        completing the handshake.
+    :param reconnect_base_delay: Delay before the first reconnect
+        attempt, in seconds.  Each further failure doubles it.
+    :param reconnect_max_delay: Upper bound of the reconnect delay.
+    :param reconnect_attempts: Consecutive failed reconnects after which
+        a dropped peer is given up.  Bootstrap peers are retried
+        forever.
+    :param ping_interval: Seconds between ``ping`` messages to a peer.
+    :param ping_timeout: Seconds a peer may leave a ``ping`` unanswered
+        before it is disconnected.
+    :param timeout_percentile: Percentile of a peer's answer latency
+        that adaptive query timeouts are based on.
+    :param timeout_margin: Minimum slack added to that percentile.  The
+        slack is half the percentile or this, whichever is larger.
+    :param rpc_timeout: Seconds to wait for the reply to a DHT request,
+        and for the next request on an idle RPC-only connection.
+    :param dht_store_size: Maximum number of values kept for ``store``
+        requests from other nodes.
+    :param dht_store_ttl: Seconds a stored value is kept.
+    :param dht_refresh_interval: Seconds between lookups of random IDs
+        that keep the routing table populated.  Zero disables the
+        lookups, including the initial one on joining.
+    :param content_terms: Callback returning the terms of the content
+        this node hosts.  If given, a filter of them is advertised to
+        peers so that they only send this node queries it may be able
+        to answer.
+    :param filter_interval: Seconds between checks for changed content.
+    :param filter_routing: Skip peers whose content filter does not
+        match a query on its last hop.  If ``False`` every peer
+        receives every query.
+    :param fanout: Maximum number of peers a query is sent or forwarded
+        to.  ``None`` sends it to every eligible peer (flooding).
+    :param fanout_mode: How the subset is chosen; one of
+        :data:`FANOUT_MODES`.
+    :param event_loop: Event loop implementation :meth:`start` runs the
+        network on; one of :data:`loops.LOOP_IMPLEMENTATIONS`.
+    :param compress_threshold: Frames of at least this many bytes are
+        compressed on connections where both sides support it.
+        ``None`` disables compression.
     """
 
-    def __init__(self, port: int, bootstrap_peers: Optional[List[str]], on_query: Callable[[str], object]):
+    def __init__(self, port: int, bootstrap_peers: Optional[List[str]], on_query: Callable[[str], object],
+                 send_timeout: float = 2.0, max_send_queue: int = 1000, overflow_policy: str = 'drop_oldest',
+                 write_batch_bytes: int = 65536, write_batch_delay: float = 0.0,
+                 dedup_capacity: int = 100_000, dedup_ttl: float = 600.0,
+                 default_ttl: int = 3, max_ttl: int = 8, route_ttl: float = 60.0,
+                 callback_mode: str = 'executor', callback_workers: int = 4,
+                 callback_executor: Optional[concurrent.futures.Executor] = None,
+                 max_inflight_per_peer: int = 8,
+                 peer_query_rate: Optional[float] = 5.0, peer_query_burst: Optional[float] = 20.0,
+                 peer_byte_rate: Optional[float] = 65536.0, peer_byte_burst: Optional[float] = 262144.0,
+                 query_rate: Optional[float] = 50.0, query_burst: Optional[float] = 100.0,
+                 byte_rate: Optional[float] = 524288.0, byte_burst: Optional[float] = 1048576.0,
+                 target_outbound: int = 8,
+                 max_inbound: int = 64, max_outbound: int = 16, handshake_timeout: float = 10.0,
+                 connect_interval: float = 5.0, connect_timeout: float = 5.0,
+                 reconnect_base_delay: float = 1.0, reconnect_max_delay: float = 60.0,
+                 reconnect_attempts: int = 10, ping_interval: float = 15.0, ping_timeout: float = 10.0,
+                 timeout_percentile: float = 95.0, timeout_margin: float = 0.25,
+                 rpc_timeout: float = 5.0, dht_store_size: int = 10_000, dht_store_ttl: float = 3600.0,
+                 dht_refresh_interval: float = 900.0,
+                 content_terms: Optional[Callable[[], Iterable[str]]] = None, filter_interval: float = 60.0,
+                 filter_routing: bool = True, fanout: Optional[int] = None, fanout_mode: str = 'random',
+                 compress_threshold: Optional[int] = 512, event_loop: str = 'auto'):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow_policy!r}, expected one of {OVERFLOW_POLICIES}")
+        if callback_mode not in CALLBACK_MODES:
+            raise ValueError(f"Unknown callback mode {callback_mode!r}, expected one of {CALLBACK_MODES}")
+        if fanout_mode not in FANOUT_MODES:
+            raise ValueError(f"Unknown fanout mode {fanout_mode!r}, expected one of {FANOUT_MODES}")
         self.port = port
         self.bootstrap_peers = bootstrap_peers or []
         self.on_query = on_query
+        self.send_timeout = send_timeout
+        self.max_send_queue = max_send_queue
+        self.overflow_policy = overflow_policy
+        self.write_batch_bytes = write_batch_bytes
+        self.write_batch_delay = write_batch_delay
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.callback_mode = callback_mode
+        self.callback_workers = callback_workers
+        self.max_inflight_per_peer = max_inflight_per_peer
+        self.peer_query_rate = peer_query_rate
+        self.peer_query_burst = peer_query_burst
+        self.peer_byte_rate = peer_byte_rate
+        self.peer_byte_burst = peer_byte_burst
+        self.query_limiter = RateLimiter(query_rate, query_burst, byte_rate, byte_burst)
+        # Shared by all inbound RPC-only connections, which would
+        # otherwise start with a full bucket each.
+        self.rpc_query_limiter = RateLimiter(peer_query_rate, peer_query_burst, peer_byte_rate, peer_byte_burst)
+        self.target_outbound = target_outbound
+        self.max_inbound = max_inbound
+        self.max_outbound = max_outbound
+        self.handshake_timeout = handshake_timeout
+        self.connect_interval = connect_interval
+        self.connect_timeout = connect_timeout
+        self.reconnect_base_delay = reconnect_base_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_attempts = reconnect_attempts
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.timeout_percentile = timeout_percentile
+        self.timeout_margin = timeout_margin
+        self.rpc_timeout = rpc_timeout
+        self.dht_refresh_interval = dht_refresh_interval
+        self.content_terms = content_terms
+        self.filter_interval = filter_interval
+        self.filter_routing = filter_routing
+        self.fanout = fanout
+        self.fanout_mode = fanout_mode
+        self.compress_threshold = compress_threshold
+
+        # Worker pool and concurrency limit for ``on_query``.
+        if callback_executor is None and callback_mode == 'executor':
+            callback_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=callback_workers, thread_name_prefix='on_query')
+        self.callback_executor = callback_executor
+        self._callback_slots = asyncio.Semaphore(callback_workers)
+        self.callbacks_running = 0
+        self.callbacks_waiting = 0
+        self.callbacks_completed = 0
+        self.callbacks_skipped = 0
 
         # Generate a random "private key" and derive a base58 encoded address.
         self._private_key = secrets.token_bytes(32)
         self.address = self._derive_address(self._private_key)
 
-        # Maps peer address strings to stream writers.
-        self.peers: Dict[str, asyncio.StreamWriter] = {}
+        # Maps peer address strings to established connections.
+        self.peers: Dict[str, PeerConnection] = {}
+
+        # Known listening addresses and the connection manager's state:
+        # addresses being dialled and addresses that turned out to be
+        # this node.
+        self.peer_table = PeerTable()
+        self._dialing: Set[Address] = set()
+        self._self_addrs: Set[Address] = set()
+        self._manager_task: Optional[asyncio.Task] = None
+        self._keepalive_task: Optional[asyncio.Task] = None
+        self.peers_evicted = 0
+
+        # Admission control counters.
+        self._handshaking = 0
+        self.connections_rejected = 0
+        self.connections_evicted = 0
+        self.handshake_timeouts = 0
+        # Queries refused by a peer's rate limits and by the global ones.
+        self.queries_rate_limited = {'peer': 0, 'global': 0}
+
+        # Addresses the reconnect supervisor keeps dialling, and how
+        # long after startup the first peer connection was made.
+        self.dial_states: Dict[Address, DialState] = {}
+        self._supervisor_wakeup = asyncio.Event()
+        self._supervisor_task: Optional[asyncio.Task] = None
+        self._started_at: Optional[float] = None
+        self.time_to_first_peer: Optional[float] = None
+
+        # Recently processed query IDs to prevent replay loops.  Memory
+        # is bounded; IDs expire after ``dedup_ttl`` seconds.
+        self.processed_queries = DedupCache(dedup_capacity, dedup_ttl)
+
+        # Queries originated by this node that are waiting for replies.
+        self.pending_queries: Dict[str, PendingQuery] = {}
+
+        # Reverse paths for queries this node forwarded: query ID to
+        # the address of the peer the query arrived from, and to the
+        # addresses of the peers it was forwarded to.
+        self.reverse_paths: ExpiringDict[str, str] = ExpiringDict(dedup_capacity, route_ttl)
+        self.forward_paths: ExpiringDict[str, Dict[str, int]] = ExpiringDict(dedup_capacity, route_ttl)
+
+        # Query IDs the origin has cancelled.  No further replies are
+        # produced or relayed for them.
+        self.cancelled_queries: ExpiringDict[str, bool] = ExpiringDict(dedup_capacity, route_ttl)
+
+        # Tasks answering received queries, by query ID, so that a
+        # cancel can stop them.
+        self.query_tasks: Dict[str, asyncio.Task] = {}
+
+        # How long answers to this node's queries took, by the direct
+        # peer they arrived through and across all peers.
+        self.response_latency: Dict[str, LatencyHistogram] = {}
+        self.global_latency = LatencyHistogram()
+
+        # Queries this node originated and the hedging they caused.
+        self.queries_sent = 0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.hedges_lost = 0
 
-        # Set of processed query IDs to prevent replay loops.
-        self.processed_queries: set[str] = set()
+        # Kademlia routing table, values other nodes stored here,
+        # requests awaiting a reply (rpc ID to connection and future)
+        # and the open RPC-only connections.
+        self.routing_table = RoutingTable(node_id(self.address))
+        self.dht_values: ExpiringDict[str, object] = ExpiringDict(dht_store_size, dht_store_ttl)
+        self.rpc_waiters: Dict[str, Tuple[PeerConnection, asyncio.Future]] = {}
+        self.rpc_connections: Set[PeerConnection] = set()
+        self.rpcs_sent = 0
+        self.rpc_failures = 0
+        self.lookups = 0
+        self.lookup_rounds = 0
+        self._dht_task: Optional[asyncio.Task] = None
 
-        # Pending queries waiting for responses.  Each entry maps a
-        # query ID to a dict containing a list of responses, the
-        # expected number of replies and an asyncio.Event used to
-        # signal completion.
-        self.pending_queries: Dict[str, Dict[str, object]] = {}
+        # This node's advertised content filter (base64) and the number
+        # of query sends skipped because a peer's filter did not match.
+        self._filter_payload: Optional[str] = None
+        self._filter_task: Optional[asyncio.Task] = None
+        self.filter_skips = 0
+
+        # Query messages sent, both originated and forwarded.
+        self.query_messages_sent = 0
 
         # Dedicated event loop for all networking tasks.  Running a
         # separate loop allows the network to operate concurrently
         # alongside FastAPI/uvicorn which will create its own loop.
-        self.loop = asyncio.new_event_loop()
+        self.loop = new_event_loop(event_loop)
 
     # ------------------------------------------------------------------
     # Public API
@@ -123,55 +903,624 @@ class P2PNetwork:
         thread = threading.Thread(target=self._start_loop, daemon=True)
         thread.start()
 
-    async def query_peers(self, query: str, timeout: float = 10.0) -> List[object]:
+    async def serve(self) -> None:
+        """Run the P2P network on the calling event loop until cancelled.
+
+        An alternative to :meth:`start` for applications that would
+        rather share one loop with the network, e.g. by starting it
+        from a FastAPI lifespan hook.
+        """
+        unused = self.loop
+        self.loop = asyncio.get_running_loop()
+        if unused is not self.loop and not unused.is_running():
+            unused.close()
+        await self._run()
+
+    def submit(self, coro: Awaitable[T]) -> concurrent.futures.Future:
+        """Schedule a coroutine on the network loop from any thread.
+
+        :returns: A :class:`concurrent.futures.Future` for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)  # type: ignore[arg-type]
+
+    async def run_threadsafe(self, coro: Awaitable[T]) -> T:
+        """Await a network coroutine from any event loop.
+
+        When called on the network loop the coroutine is awaited
+        directly.  Otherwise it runs on the network loop and the
+        result is handed back to the caller's loop; cancelling the
+        caller cancels the work on the network loop as well.
+
+        Example::
+
+            responses = await network.run_threadsafe(network.query_peers(query))
+        """
+        if _running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+    async def stream_threadsafe(self, stream: AsyncIterator[T]) -> AsyncIterator[T]:
+        """Iterate over a network async iterator from any event loop.
+
+        The iterator, e.g. one returned by :meth:`query_peers_stream`,
+        is driven on the network loop and each item is passed to the
+        caller's loop as soon as it is produced.  If the caller stops
+        iterating the underlying iterator is closed on the network
+        loop.
+        """
+        if _running_loop() is self.loop:
+            async for item in stream:
+                yield item
+            return
+        caller = asyncio.get_running_loop()
+        items: asyncio.Queue = asyncio.Queue()
+        end = object()
+
+        async def pump() -> None:
+            try:
+                async for item in stream:
+                    caller.call_soon_threadsafe(items.put_nowait, (item, None))
+            except BaseException as exc:
+                caller.call_soon_threadsafe(items.put_nowait, (end, exc))
+                raise
+            caller.call_soon_threadsafe(items.put_nowait, (end, None))
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item, exc = await items.get()
+                if item is end:
+                    if exc is not None and not isinstance(exc, asyncio.CancelledError):
+                        raise exc
+                    return
+                yield item
+        finally:
+            future.cancel()
+
+    async def query_peers(self, query: str, timeout: float = 10.0, ttl: Optional[int] = None,
+                          policy: CompletionPolicy = ALL_RESPONSES, adaptive: bool = True,
+                          max_peers: Optional[int] = None, hedge: bool = False) -> List[object]:
         """Broadcast a query to all connected peers and collect their responses.
 
         A unique UUID is generated for the query.  The query is sent
         to every currently connected peer.  The method returns a list
         of responses.  If no peers are connected an empty list is
-        returned.  If not all peers reply before the given timeout
-        expires only the received responses are returned.  The query
-        remains in the processed set to prevent reprocessing on
-        future broadcasts.
+        returned.  The query is queued on every peer's connection
+        without waiting for any of them to accept it, so a slow peer
+        cannot delay the others.  If not all peers reply before the
+        timeout expires only the received responses are returned.  The
+        query remains in the duplicate filter to prevent reprocessing
+        on future broadcasts.
 
         :param query: The question or task to broadcast to peers.
         :param timeout: Maximum number of seconds to wait for replies.
+            With ``adaptive`` the wait usually ends sooner.
+        :param ttl: Number of hops the query may travel.  Defaults to
+            the node's ``default_ttl``.
+        :param policy: Decides when enough responses have arrived.
+            Once it is satisfied the query is cancelled at the peers
+            that are still working on it.  By default all replies are
+            awaited.
+        :param adaptive: Derive the deadline from how long the queried
+            peers usually take to answer (see :meth:`adaptive_timeout`),
+            capped at ``timeout``.
+        :param max_peers: Send the query to at most this many peers,
+            preferring those that usually answer fastest.  By default
+            every connected peer is queried.
+        :param hedge: If a queried peer has not answered within its
+            usual p90 latency, send the query to a peer that was not
+            queried yet and keep whichever answer arrives first.  Only
+            has an effect together with ``max_peers`` and a ``ttl`` of
+            1, so that each answer is the queried peer's own.
         :returns: A list of response objects from peers.
         """
+        stream = self.query_peers_stream(query, timeout, ttl, policy, adaptive, max_peers, hedge)
+        return [response async for response in stream]
+
+    async def query_peers_stream(self, query: str, timeout: float = 10.0, ttl: Optional[int] = None,
+                                 policy: CompletionPolicy = ALL_RESPONSES, adaptive: bool = True,
+                                 max_peers: Optional[int] = None, hedge: bool = False) -> AsyncIterator[object]:
+        """Broadcast a query and yield peer responses as they arrive.
+
+        Behaves like :meth:`query_peers` but hands each response to the
+        caller the moment it is received instead of waiting for the
+        slowest peer.  Iteration ends once every node the query reached
+        has replied, the policy is satisfied or the timeout expires.
+        If it ends, or the caller stops iterating, before all replies
+        are in, the query is cancelled at the peers.
+        """
         if not self.peers:
-            return []
+            return
+        start = self.loop.time()
+        pending = self._send_query(query, self.default_ttl if ttl is None else ttl, max_peers)
+        deadline = start + (self.adaptive_timeout(pending.targets, timeout) if adaptive else timeout)
+        hedger = self.loop.create_task(self._hedge(pending)) if hedge else None
+        # The policy judges what the caller received: ``pending.responses``
+        # also holds answers still queued for the next iterations.
+        yielded: List[object] = []
+        try:
+            while True:
+                try:
+                    response = await asyncio.wait_for(pending.next_arrival(), max(0.0, deadline - self.loop.time()))
+                except asyncio.TimeoutError:
+                    print("Timed out waiting for peer responses")
+                    self._record_censored(pending)
+                    return
+                if response is PendingQuery.DONE:
+                    return
+                yield response
+                yielded.append(response)
+                if policy.satisfied(yielded):
+                    return
+        finally:
+            # Clean up pending state; late replies are dropped.
+            if hedger is not None:
+                hedger.cancel()
+            self.pending_queries.pop(pending.id, None)
+            if not pending.done.is_set():
+                self._cancel_query(pending)
+
+    def adaptive_timeout(self, peer_ids: List[str], ceiling: float) -> float:
+        """Return how long to wait for answers from ``peer_ids``.
+
+        Each peer's expected answer time is the ``timeout_percentile``
+        of its latency histogram, or of all peers' answers while it
+        has too few samples of its own.  The slowest peer's estimate
+        plus a margin is returned, but never more than ``ceiling``.
+        Without enough history to go by ``ceiling`` itself is returned.
+        """
+        estimates = []
+        for peer_id in peer_ids:
+            estimate = self.expected_latency(peer_id, self.timeout_percentile)
+            if estimate is None:
+                return ceiling
+            estimates.append(estimate)
+        if not estimates:
+            return ceiling
+        slowest = max(estimates)
+        return min(ceiling, slowest + max(self.timeout_margin, slowest / 2))
+
+    def expected_latency(self, peer_id: str, pct: float) -> Optional[float]:
+        """Return the ``pct`` percentile of answer latency through ``peer_id``.
+
+        Falls back to the histogram of all peers while the peer has
+        fewer than :data:`ADAPTIVE_MIN_SAMPLES` answers, and returns
+        ``None`` if that has too few as well.
+        """
+        histogram = self.response_latency.get(peer_id)
+        if histogram is None or histogram.count < ADAPTIVE_MIN_SAMPLES:
+            histogram = self.global_latency
+        if histogram.count < ADAPTIVE_MIN_SAMPLES:
+            return None
+        return histogram.percentile(pct)
+
+    async def find_node(self, address: str) -> Optional[Contact]:
+        """Locate the node with ``address`` through the DHT.
+
+        :returns: How to reach the node, or ``None`` if the lookup did
+            not find it.
+        """
+        target = node_id(address)
+        contacts, _ = await self._lookup(target, exact=True)
+        return next((contact for contact in contacts if contact.id == target), None)
+
+    async def find_value(self, key: str) -> Optional[object]:
+        """Return the value stored in the DHT under ``key``, or ``None``."""
+        if key in self.dht_values:
+            return self.dht_values.get(key)
+        _, reply = await self._lookup(key_id(key), key)
+        return None if reply is None else reply.get('value')
+
+    async def store(self, key: str, value: object) -> int:
+        """Store ``value`` under ``key`` on the nodes closest to the key.
+
+        This node keeps a copy too if it is among the closest.
+
+        :returns: The number of nodes that stored the value.
+        :raises ValueError: If the entry is not JSON serialisable or
+            exceeds :data:`MAX_DHT_VALUE_BYTES`.
+        """
+        if not _storable(key, value):
+            raise ValueError(f"DHT entries must be JSON of at most {MAX_DHT_VALUE_BYTES} bytes")
+        target = key_id(key)
+        contacts, _ = await self._lookup(target)
+        replies = await asyncio.gather(*(self._rpc(contact, 'store', {'key': key, 'value': value})
+                                         for contact in contacts))
+        stored = sum(1 for reply in replies if reply is not None and reply.get('ok'))
+        own_id = self.routing_table.own_id
+        if len(contacts) < K or own_id ^ target < contacts[-1].id ^ target:
+            self.dht_values[key] = value
+            stored += 1
+        return stored
+
+    async def query_agent(self, address: str, query: str, timeout: float = 30.0) -> object:
+        """Send ``query`` to the node with ``address`` alone and return its answer.
+
+        The node is located through the DHT unless it is a direct peer.
+
+        :raises LookupError: If the node cannot be found or does not
+            answer within ``timeout`` seconds.
+        """
+        if address == self.address:
+            return await self._run_callback(str(uuid.uuid4()), query)
+        peer = self.peers.get(address)
+        if peer is not None:
+            contact: Optional[Contact] = Contact(address, *(peer.listen_addr or ('', 0)))
+        else:
+            contact = await self.find_node(address)
+        if contact is None:
+            raise LookupError(f"Node {address} not found")
+        reply = await self._rpc(contact, 'query', {'payload': query}, timeout)
+        if reply is None:
+            raise LookupError(f"Node {address} did not answer")
+        return reply.get('response', {'error': reply.get('error')})
+
+    def stats(self) -> Dict[str, object]:
+        """Return a snapshot of network state for monitoring."""
+        return {
+            'address': self.address,
+            'event_loop': loop_name(self.loop),
+            'peers': {peer_id: peer.stats() for peer_id, peer in self.peers.items()},
+            'pending_queries': len(self.pending_queries),
+            'reverse_paths': len(self.reverse_paths),
+            'dedup': self.processed_queries.stats(),
+            'peer_table': self.peer_table.stats(),
+            'reconnect': {f"{host}:{port}": state.stats() for (host, port), state in self.dial_states.items()},
+            'time_to_first_peer': self.time_to_first_peer,
+            'peers_evicted': self.peers_evicted,
+            'rate_limit': {
+                'global': self.query_limiter.stats(),
+                'refused': dict(self.queries_rate_limited),
+            },
+            'admission': {
+                'inbound': sum(1 for peer in self.peers.values() if not peer.outbound),
+                'outbound': sum(1 for peer in self.peers.values() if peer.outbound),
+                'max_inbound': self.max_inbound,
+                'max_outbound': self.max_outbound,
+                'handshaking': self._handshaking,
+                'rejected': self.connections_rejected,
+                'evicted': self.connections_evicted,
+                'handshake_timeouts': self.handshake_timeouts,
+            },
+            'latency': {
+                'all': self.global_latency.stats(),
+                'peers': {peer_id: histogram.stats() for peer_id, histogram in self.response_latency.items()},
+            },
+            'hedging': {
+                'queries': self.queries_sent,
+                'hedges_sent': self.hedges_sent,
+                'hedges_won': self.hedges_won,
+                'hedges_lost': self.hedges_lost,
+                # Extra query messages per originated query.
+                'extra_load': self.hedges_sent / self.queries_sent if self.queries_sent else 0.0,
+            },
+            'content_filter': {
+                'advertised_bytes': len(base64.b64decode(self._filter_payload)) if self._filter_payload else 0,
+                'peers_with_filter': sum(1 for peer in self.peers.values() if peer.content_filter is not None),
+                'sends_skipped': self.filter_skips,
+            },
+            'gossip': {
+                'fanout': self.fanout,
+                'mode': self.fanout_mode,
+                'query_messages_sent': self.query_messages_sent,
+            },
+            'dht': dict(self.routing_table.stats(), values=len(self.dht_values), lookups=self.lookups,
+                        lookup_rounds=self.lookup_rounds, rpcs_sent=self.rpcs_sent,
+                        rpc_failures=self.rpc_failures, rpc_connections=len(self.rpc_connections)),
+            'callbacks': {
+                'mode': self.callback_mode,
+                'max_concurrency': self.callback_workers,
+                'running': self.callbacks_running,
+                'waiting': self.callbacks_waiting,
+                'completed': self.callbacks_completed,
+                'skipped_cancelled': self.callbacks_skipped,
+            },
+        }
+
+    # ------------------------------------------------------------------
+    # Private helpers
+
+    def _send_query(self, query: str, ttl: int, max_peers: Optional[int] = None) -> PendingQuery:
+        """Register a new query and queue it on every connected peer.
+
+        With ``max_peers`` only that many of the fastest peers are used,
+        otherwise ``fanout`` limits the number of peers as for
+        forwarded queries.
+        """
         qid = str(uuid.uuid4())
         # Mark as processed locally to prevent loopback processing when
         # our own message propagates back to us.
         self.processed_queries.add(qid)
-        # Prepare aggregator entry.
-        agg = {
-            'responses': [],
-            'remaining': len(self.peers),
-            'event': asyncio.Event()
-        }
-        self.pending_queries[qid] = agg
+        self.queries_sent += 1
+        query_terms = terms(query)
+        targets = self._rank_peers(self._matching_peers(self.peers.values(), query_terms, ttl))
+        if max_peers is not None:
+            targets = targets[:max_peers]
+        else:
+            targets = self._select_fanout(targets)
+        pending = PendingQuery(qid, len(targets))
+        self.pending_queries[qid] = pending
         # Build query message once.
-        msg = {'type': 'query', 'id': qid, 'origin': self.address, 'payload': query}
-        # Send to all peers.
-        for peer_id, writer in list(self.peers.items()):
-            try:
-                await self._send_message(writer, msg)
-            except Exception as exc:
-                # Treat errors as missing responses.
-                print(f"Error sending query to peer {peer_id}: {exc}")
-                agg['remaining'] -= 1
-        # Wait for responses or until timeout.
+        msg = {'type': 'query', 'id': qid, 'origin': self.address, 'payload': query, 'ttl': ttl}
+        pending.message = msg
+        pending.query_terms = query_terms
+        # Queue on all peers.  Dropped sends are treated as missing
+        # responses.
+        sent = self._broadcast(msg, targets)
+        self.query_messages_sent += len(sent)
+        pending.targets = [peer.address for peer in sent]
+        pending.outstanding = {peer.address: 1 for peer in sent}
+        pending.resolve(len(targets) - len(sent))
+        return pending
+
+    def _matching_peers(self, peers: Iterable[PeerConnection], query_terms: Set[str],
+                        ttl: int) -> List[PeerConnection]:
+        """Return the ``peers`` whose content filter matches ``query_terms``.
+
+        :param ttl: The ``ttl`` the query is sent with.  Above 1 the
+            peers may forward it, so all of them are returned.
+        """
+        peers = list(peers)
+        if not self.filter_routing or ttl > 1:
+            return peers
+        matching = [peer for peer in peers if matches(peer.content_filter, query_terms)]
+        self.filter_skips += len(peers) - len(matching)
+        return matching
+
+    def _select_fanout(self, peers: List[PeerConnection]) -> List[PeerConnection]:
+        """Pick at most ``fanout`` of ``peers`` to send a query to.
+
+        In ``weighted`` mode a peer's chance of being picked is
+        proportional to the inverse of its median answer latency (or
+        its ping round trip before any answers); peers without either
+        count as typical.
+        """
+        if self.fanout is None or len(peers) <= self.fanout:
+            return list(peers)
+        if self.fanout_mode == 'random':
+            return random.sample(peers, self.fanout)
+        latencies = [self.expected_latency(peer.address, 50) or peer.rtt.srtt for peer in peers]
+        known = [latency for latency in latencies if latency]
+        typical = sorted(known)[len(known) // 2] if known else 1.0
+        # Weighted sampling without replacement (Efraimidis-Spirakis):
+        # keep the peers with the largest random() ** (1 / weight).
+        keyed = [(random.random() ** (latency or typical), peer) for latency, peer in zip(latencies, peers)]
+        keyed.sort(key=lambda item: item[0], reverse=True)
+        return [peer for _, peer in keyed[:self.fanout]]
+
+    def _rank_peers(self, peers: List[PeerConnection]) -> List[PeerConnection]:
+        """Order ``peers`` by median answer latency, fastest first.
+
+        Peers without enough history are ranked as a typical peer;
+        ties are broken randomly to spread load.
+        """
+        peers = list(peers)
+        random.shuffle(peers)
+        typical = self.global_latency.percentile(50) or 0.0
+        return sorted(peers, key=lambda peer: self.expected_latency(peer.address, 50) or typical)
+
+    async def _hedge(self, pending: PendingQuery) -> None:
+        """Hedge every queried peer that is slower than its usual p90.
+
+        At each queried peer's p90 answer latency, if it has not
+        answered yet, the query is sent to the fastest peer that was
+        not queried.  Peers without a latency estimate are not hedged,
+        and neither are queries that travel further than one hop.
+        """
+        if pending.message['ttl'] != 1:
+            return
+        due = {}
+        for peer_id in pending.targets:
+            p90 = self.expected_latency(peer_id, 90)
+            if p90 is not None:
+                due[peer_id] = pending.started + p90
+        while due and not pending.done.is_set():
+            peer_id = min(due, key=due.__getitem__)
+            await asyncio.sleep(max(0.0, due.pop(peer_id) - time.monotonic()))
+            if peer_id in pending.answered or not pending.outstanding.get(peer_id):
+                continue
+            spares = self._matching_peers([peer for peer in self.peers.values() if peer.address not in pending.targets],
+                                          pending.query_terms, pending.message['ttl'])  # type: ignore[arg-type]
+            if not spares:
+                return
+            spare = self._rank_peers(spares)[0]
+            if not spare.send(pending.message):
+                continue
+            self.hedges_sent += 1
+            self.query_messages_sent += 1
+            pending.targets.append(spare.address)
+            pending.expect(1, via=spare.address)
+            pending.hedge_peers.add(spare.address)
+            pending.rivals[peer_id] = spare.address
+            pending.rivals[spare.address] = peer_id
+
+    def _supersede(self, pending: PendingQuery, winner: str) -> None:
+        """Keep ``winner``'s answer and cancel the peer it was paired with."""
+        loser = pending.rivals.pop(winner)
+        pending.rivals.pop(loser, None)
+        if winner in pending.hedge_peers:
+            self.hedges_won += 1
+        else:
+            self.hedges_lost += 1
+        pending.superseded.add(loser)
+        pending.peer_lost(loser)
+        peer = self.peers.get(loser)
+        if peer is not None:
+            peer.send({'type': 'cancel', 'id': pending.id})
+
+    async def _lookup(self, target: int, key: Optional[str] = None, exact: bool = False
+                      ) -> Tuple[List[Contact], Optional[Dict[str, object]]]:
+        """Iteratively find the contacts closest to ``target``.
+
+        Each round asks the :data:`ALPHA` closest contacts not asked
+        yet for contacts closer still, until the :data:`K` closest
+        answering contacts have all been asked.  With ``key`` the
+        contacts are asked for the value under that key instead, and
+        the lookup stops at the first one that has it.  With ``exact``
+        it stops as soon as the contact with ID ``target`` is known.
+
+        :returns: The closest contacts found, and the reply carrying
+            the value if one was found.
+        """
+        self.lookups += 1
+        own_id = self.routing_table.own_id
+        shortlist = {contact.id: contact for contact in self.routing_table.closest(target, K)}
+        asked: Set[int] = set()
+        failed: Set[int] = set()
+        if key is None:
+            method, params = 'find_node', {'target': format(target, 'x')}
+        else:
+            method, params = 'find_value', {'key': key}
+
+        def closest_alive() -> List[Contact]:
+            alive = [contact for contact in shortlist.values() if contact.id not in failed]
+            return sorted(alive, key=lambda contact: contact.id ^ target)[:K]
+
+        while True:
+            if exact and target in shortlist:
+                return closest_alive(), None
+            batch = [contact for contact in closest_alive() if contact.id not in asked][:ALPHA]
+            if not batch:
+                return closest_alive(), None
+            self.lookup_rounds += 1
+            asked.update(contact.id for contact in batch)
+            replies = await asyncio.gather(*(self._rpc(contact, method, params) for contact in batch))
+            for contact, reply in zip(batch, replies):
+                if reply is None:
+                    failed.add(contact.id)
+                    continue
+                if key is not None and 'value' in reply:
+                    return closest_alive(), reply
+                entries = reply.get('contacts')
+                for entry in entries if isinstance(entries, list) else []:
+                    found = Contact.from_wire(entry)
+                    if found is not None and found.id != own_id and found.id not in shortlist:
+                        shortlist[found.id] = found
+
+    async def _rpc(self, contact: Contact, method: str, params: Dict[str, object],
+                   timeout: Optional[float] = None) -> Optional[Dict[str, object]]:
+        """Send a DHT request to ``contact`` and wait for the reply.
+
+        A contact that is not a peer is reached over an RPC-only
+        connection, closed again when this request is done.  Contacts
+        that cannot be reached or do not reply are removed from the
+        routing table.
+
+        :returns: The ``rpc_reply`` message, or ``None`` on failure.
+        """
+        peer = self.peers.get(contact.address)
+        transient = None
+        if peer is None and contact.port:
+            peer = transient = await self._connect((contact.host, contact.port), rpc_only=True)
+        reply = None
         try:
-            await asyncio.wait_for(agg['event'].wait(), timeout=timeout)
-        except asyncio.TimeoutError:
-            print("Timed out waiting for peer responses")
-        # Clean up pending state and return a snapshot of responses.
-        self.pending_queries.pop(qid, None)
-        return list(agg['responses'])
+            if peer is not None and peer.address == contact.address:
+                rpc_id = str(uuid.uuid4())
+                future = self.loop.create_future()
+                self.rpc_waiters[rpc_id] = (peer, future)
+                self.rpcs_sent += 1
+                try:
+                    if peer.send(dict(params, type='rpc', method=method, rpc_id=rpc_id)):
+                        reply = await asyncio.wait_for(future, self.rpc_timeout if timeout is None else timeout)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self.rpc_waiters.pop(rpc_id, None)
+        finally:
+            if transient is not None:
+                transient.close()
+        if reply is None:
+            self.rpc_failures += 1
+            self.routing_table.remove(contact.id)
+        return reply
 
-    # ------------------------------------------------------------------
-    # Private helpers
+    def _refresh_filter(self) -> bool:
+        """Rebuild this node's content filter.
+
+        :returns: ``True`` if it differs from the one advertised so far.
+        """
+        try:
+            content = list(self.content_terms()) if self.content_terms is not None else []
+        except Exception as exc:
+            print(f"Error collecting content terms: {exc}")
+            return False
+        payload = base64.b64encode(build_filter(content).to_bytes()).decode('ascii') if content else None
+        changed = payload != self._filter_payload
+        self._filter_payload = payload
+        return changed
+
+    async def _advertise_filter(self) -> None:
+        """Send peers a new ``filter`` whenever the hosted content changes."""
+        while True:
+            await asyncio.sleep(self.filter_interval)
+            if self._refresh_filter():
+                self._broadcast({'type': 'filter', 'filter': self._filter_payload}, list(self.peers.values()))
+
+    def _send_filter(self, peer: PeerConnection) -> None:
+        """Tell a newly connected peer this node's content filter, if it has one."""
+        if self._filter_payload is not None:
+            self._broadcast({'type': 'filter', 'filter': self._filter_payload}, [peer])
+
+    def _set_peer_filter(self, peer: PeerConnection, payload: object) -> None:
+        """Decode and store a content filter advertised by ``peer``.
+
+        A missing filter means the peer wants every query.
+        """
+        if payload is None:
+            peer.content_filter = None
+            return
+        if not isinstance(payload, str) or len(payload) > MAX_FILTER_BYTES * 4 // 3 + 4:
+            return
+        try:
+            peer.content_filter = BloomFilter.from_bytes(base64.b64decode(payload, validate=True))
+        except ValueError as exc:
+            print(f"Ignoring invalid content filter from peer {peer.address}: {exc}")
+
+    async def _refresh_dht(self) -> None:
+        """Populate the routing table and keep it fresh.
+
+        Once the first peer is connected the node looks up its own ID,
+        which fills its nearby buckets and makes it known to its
+        neighbours, as in Kademlia's join procedure.  Afterwards a
+        random ID is looked up every ``dht_refresh_interval`` seconds.
+        """
+        while not self.peers:
+            await asyncio.sleep(1.0)
+        await self._lookup(self.routing_table.own_id)
+        while True:
+            await asyncio.sleep(self.dht_refresh_interval)
+            await self._lookup(secrets.randbits(160))
+
+    def _dht_seen(self, peer: PeerConnection) -> None:
+        """Add a peer we heard from to the routing table."""
+        if peer.listen_addr is not None:
+            self.routing_table.update(Contact(peer.address, *peer.listen_addr))
+
+    def _record_latency(self, peer_id: str, latency: float) -> None:
+        """Record how long an answer arriving through ``peer_id`` took."""
+        histogram = self.response_latency.get(peer_id)
+        if histogram is None:
+            histogram = self.response_latency[peer_id] = LatencyHistogram()
+        histogram.record(latency)
+        self.global_latency.record(latency)
+
+    def _record_censored(self, pending: PendingQuery) -> None:
+        """Record answers a timed out query was still waiting for.
+
+        Their latency is at least the time waited.  Recording that much
+        keeps a deadline that is too short from hiding the answers
+        that would have shown it was too short; the next deadline is
+        longer.
+        """
+        elapsed = time.monotonic() - pending.started
+        for peer_id, count in pending.outstanding.items():
+            for _ in range(count):
+                self._record_latency(peer_id, elapsed)
+
+    def _cancel_query(self, pending: PendingQuery) -> None:
+        """Tell the peers a query was sent to that it is no longer needed."""
+        peers = [self.peers[peer_id] for peer_id in pending.targets if peer_id in self.peers]
+        self._broadcast({'type': 'cancel', 'id': pending.id}, peers)
 
     def _start_loop(self) -> None:
         """Internal helper to run the event loop forever."""
@@ -180,9 +1529,11 @@ class P2PNetwork:
 
     async def _run(self) -> None:
         """Coroutine that starts the server and connects to bootstrap peers."""
+        self._started_at = time.monotonic()
         server = await asyncio.start_server(self._handle_incoming, host='0.0.0.0', port=self.port)
         print(f"P2P network listening on port {self.port}, address {self.address}")
-        # Attempt to establish outbound connections to bootstrap peers.
+        # Hand the bootstrap peers to the reconnect supervisor, which
+        # keeps dialling them until they accept.
         for peer in self.bootstrap_peers:
             # Expect host:port strings.
             try:
@@ -191,14 +1542,156 @@ class P2PNetwork:
             except ValueError:
                 print(f"Invalid bootstrap peer entry: {peer}, expected host:port")
                 continue
-            try:
-                reader, writer = await asyncio.open_connection(host, port)
-                await self._outgoing_handshake(reader, writer)
-            except Exception as exc:
-                print(f"Failed to connect to bootstrap peer {peer}: {exc}")
+            self.peer_table.add((host, port))
+            self.dial_states[(host, port)] = self._dial_state((host, port), persistent=True)
+        if self.content_terms is not None:
+            self._refresh_filter()
+            self._filter_task = self.loop.create_task(self._advertise_filter())
+        self._supervisor_task = self.loop.create_task(self._supervise())
+        # Keep dialling addresses learned from peers from now on.
+        self._manager_task = self.loop.create_task(self._maintain_outbound())
+        self._keepalive_task = self.loop.create_task(self._keepalive())
+        if self.dht_refresh_interval > 0:
+            self._dht_task = self.loop.create_task(self._refresh_dht())
         async with server:
             await server.serve_forever()
 
+    async def _maintain_outbound(self) -> None:
+        """Keep ``target_outbound`` outbound connections open.
+
+        Every ``connect_interval`` seconds the manager counts the
+        outbound connections and dials addresses chosen by the peer
+        table for the missing ones.
+        """
+        while True:
+            outbound = sum(1 for peer in self.peers.values() if peer.outbound)
+            missing = min(self.target_outbound, self.max_outbound) - outbound - len(self._dialing)
+            exclude = self._connected_addrs() | self._dialing | self._self_addrs | set(self.dial_states)
+            for _ in range(missing):
+                addr = self.peer_table.select(exclude)
+                if addr is None:
+                    break
+                exclude.add(addr)
+                self.loop.create_task(self._connect(addr))
+            await asyncio.sleep(self.connect_interval)
+
+    async def _keepalive(self) -> None:
+        """Ping every peer periodically and evict the ones that stop answering."""
+        while True:
+            await asyncio.sleep(min(self.ping_interval, self.ping_timeout) / 2)
+            now = time.monotonic()
+            for peer in list(self.peers.values()):
+                if peer.ping_nonce is not None:
+                    if now - peer.ping_sent_at > self.ping_timeout:
+                        print(f"Peer {peer.address} did not answer ping within {self.ping_timeout}s, disconnecting")
+                        self.peers_evicted += 1
+                        peer.close()
+                elif now - peer.ping_sent_at >= self.ping_interval:
+                    peer.ping_nonce = secrets.randbits(63)
+                    peer.ping_sent_at = now
+                    peer.send({'type': 'ping', 'nonce': peer.ping_nonce})
+
+    def _dial_state(self, addr: Address, persistent: bool = False) -> DialState:
+        return DialState(addr, persistent, self.reconnect_base_delay, self.reconnect_max_delay,
+                         self.reconnect_attempts)
+
+    async def _supervise(self) -> None:
+        """Dial the addresses in ``dial_states`` whenever they are due."""
+        while True:
+            now = time.monotonic()
+            for state in list(self.dial_states.values()):
+                if state.due(now):
+                    state.connecting()
+                    self.loop.create_task(self._redial(state))
+            self._supervisor_wakeup.clear()
+            waits = [state.next_attempt - now for state in self.dial_states.values()
+                     if state.state in (IDLE, BACKOFF)]
+            try:
+                await asyncio.wait_for(self._supervisor_wakeup.wait(), max(0.0, min(waits, default=self.connect_interval)))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _redial(self, state: DialState) -> None:
+        """Make one connection attempt for the supervisor."""
+        peer = await self._connect(state.addr)
+        if peer is None:
+            state.failed()
+            if state.exhausted() or state.addr in self._self_addrs:
+                print(f"Giving up on peer {state.addr[0]}:{state.addr[1]} after {state.failures} attempts")
+                self.dial_states.pop(state.addr, None)
+            else:
+                self._supervisor_wakeup.set()
+            return
+        state.connected(peer.address)
+        if peer.closed:
+            state.disconnected()
+            self._supervisor_wakeup.set()
+            return
+        if state.connects > 1:
+            print(f"Reconnected to peer {peer.address} after {state.time_to_connect:.2f}s")
+
+    def _peer_lost(self, peer: PeerConnection) -> None:
+        """Hand a peer whose connection dropped to the reconnect supervisor.
+
+        Watched peers go into backoff; other outbound peers start being
+        watched.  Nothing happens if the node is still connected over
+        another connection or evicted the peer itself.
+        """
+        if peer.address in self.peers:
+            return
+        if peer.evicted:
+            # Redialling would only evict another peer in turn.
+            for key, state in list(self.dial_states.items()):
+                if state.peer_id == peer.address and not state.persistent:
+                    del self.dial_states[key]
+            return
+        for state in self.dial_states.values():
+            if state.peer_id == peer.address and state.state == CONNECTED:
+                state.disconnected()
+                self._supervisor_wakeup.set()
+                return
+        if peer.outbound and peer.listen_addr is not None and peer.listen_addr not in self.dial_states:
+            state = self._dial_state(peer.listen_addr)
+            state.peer_id = peer.address
+            state.disconnected()
+            self.dial_states[peer.listen_addr] = state
+            self._supervisor_wakeup.set()
+
+    def _connected_addrs(self) -> Set[Address]:
+        """Listening addresses of the currently connected peers."""
+        return {peer.listen_addr for peer in self.peers.values() if peer.listen_addr is not None}
+
+    async def _connect(self, addr: Address, rpc_only: bool = False) -> Optional[PeerConnection]:
+        """Dial ``addr`` and perform the outbound handshake.
+
+        The attempt is recorded in the peer table; a completed
+        handshake moves the address to its tried table.
+
+        :param rpc_only: Open an RPC-only connection, which the caller
+            has to close, instead of a peer connection.
+        :returns: The connection to the node at ``addr``, which may be
+            an existing one if the two nodes were already connected,
+            or ``None`` if the attempt failed.
+        """
+        host, port = addr
+        self._dialing.add(addr)
+        self.peer_table.mark_attempt(addr)
+        try:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as exc:
+                print(f"Failed to connect to peer {host}:{port}: {exc!r}")
+                return None
+            try:
+                return await asyncio.wait_for(self._outgoing_handshake(reader, writer, addr, rpc_only),
+                                              self.connect_timeout)
+            except Exception as exc:
+                print(f"Handshake with peer {host}:{port} failed: {exc!r}")
+                writer.close()
+                return None
+        finally:
+            self._dialing.discard(addr)
+
     # Base58 encoding used for simplified address derivation.
     @staticmethod
     def _base58_encode(data: bytes) -> str:
@@ -233,19 +1726,43 @@ class P2PNetwork:
         checksum = hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
         return self._base58_encode(payload + checksum)
 
-    async def _outgoing_handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-        """Perform a version/verack handshake on an outbound connection."""
+    def _version_message(self, rpc_only: bool = False) -> Dict[str, object]:
+        """Build this node's ``version`` handshake message."""
+        version: Dict[str, object] = {'type': 'version', 'address': self.address, 'codecs': available_codecs(),
+                                      'port': self.port}
+        if rpc_only:
+            version['rpc_only'] = True
+        if self.compress_threshold is not None:
+            version['compression'] = available_compressors()
+        return version
+
+    async def _outgoing_handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                  dialed: Address, rpc_only: bool = False) -> Optional[PeerConnection]:
+        """Perform a version/verack handshake on an outbound connection.
+
+        :param dialed: The listening address the connection was made to.
+        :param rpc_only: Ask for an RPC-only connection.
+        """
         # Send our version.
-        version_msg = {'type': 'version', 'address': self.address}
-        await self._send_message(writer, version_msg)
+        await self._send_message(writer, self._version_message(rpc_only))
         # Wait for the peer's version.
         msg = await self._read_message(reader)
         if msg.get('type') != 'version':
             print("Unexpected message during handshake (outgoing):", msg)
             writer.close()
             await writer.wait_closed()
-            return
+            return None
         remote_addr = msg.get('address')
+        if remote_addr == self.address:
+            # We dialled ourselves; never try this address again.
+            self._self_addrs.add(dialed)
+            self.peer_table.remove(dialed)
+            writer.close()
+            return None
+        codec = negotiate(available_codecs(), msg.get('codecs'))  # type: ignore[arg-type]
+        if self.compress_threshold is not None:
+            codec = negotiate_compression(codec, available_compressors(), msg.get('compression'),  # type: ignore[arg-type]
+                                          self.compress_threshold)
         # Send and receive verack.
         await self._send_message(writer, {'type': 'verack'})
         msg2 = await self._read_message(reader)
@@ -253,14 +1770,31 @@ class P2PNetwork:
             print("Expected verack during handshake (outgoing)")
             writer.close()
             await writer.wait_closed()
-            return
-        # Store the peer writer and spawn a reader task.
-        self.peers[remote_addr] = writer
-        print(f"Connected to peer {remote_addr}")
+            return None
+        self.peer_table.mark_good(dialed)
+        if rpc_only:
+            peer = self._rpc_connection(remote_addr, reader, writer, codec, outbound=True)
+            peer.listen_addr = dialed
+            self.loop.create_task(self._rpc_reader(peer))
+            return peer
+        # Store the connection and spawn a reader task.
+        peer = self._register_peer(remote_addr, reader, writer, codec, outbound=True)
+        if peer is None:
+            writer.close()
+            # Already connected to this node the other way round, or
+            # refused because of the connection limit.
+            return self.peers.get(remote_addr)
+        peer.listen_addr = dialed
+        self._send_filter(peer)
+        self._dht_seen(peer)
+        print(f"Connected to peer {remote_addr} using {codec.name}")
         # Launch a task to handle incoming messages from this peer.
-        self.loop.create_task(self._peer_reader(remote_addr, reader, writer))
+        self.loop.create_task(self._peer_reader(peer))
+        # Ask the new peer which other nodes it knows.
+        peer.send({'type': 'getaddr'})
+        return peer
 
-    async def _incoming_handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[str]:
+    async def _incoming_handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[PeerConnection]:
         """Perform a version/verack handshake on an inbound connection."""
         # Expect the peer's version first.
         msg = await self._read_message(reader)
@@ -268,34 +1802,206 @@ class P2PNetwork:
             print("Unexpected message during handshake (incoming):", msg)
             return None
         remote_addr = msg.get('address')
-        # Respond with our version.
-        await self._send_message(writer, {'type': 'version', 'address': self.address})
+        codec = negotiate(msg.get('codecs'), available_codecs())  # type: ignore[arg-type]
+        if self.compress_threshold is not None:
+            codec = negotiate_compression(codec, msg.get('compression'), available_compressors(),  # type: ignore[arg-type]
+                                          self.compress_threshold)
+        # Respond with our version.  A node that dialled itself learns
+        # so from it and forgets the address.
+        await self._send_message(writer, self._version_message())
+        if remote_addr == self.address:
+            return None
         # Expect verack and send back verack.
         msg2 = await self._read_message(reader)
         if msg2.get('type') != 'verack':
             print("Expected verack during handshake (incoming)")
             return None
         await self._send_message(writer, {'type': 'verack'})
-        # Save the writer and spawn a reader task.
-        self.peers[remote_addr] = writer
-        print(f"Accepted connection from peer {remote_addr}")
-        return remote_addr
+        # Save the connection; the caller runs its reader.
+        if msg.get('rpc_only'):
+            if sum(1 for conn in self.rpc_connections if not conn.outbound) >= self.max_inbound:
+                self.connections_rejected += 1
+                return None
+            peer = self._rpc_connection(remote_addr, reader, writer, codec, outbound=False)
+        else:
+            peer = self._register_peer(remote_addr, reader, writer, codec, outbound=False)
+            if peer is None:
+                return None
+            print(f"Accepted connection from peer {remote_addr} using {codec.name}")
+            self._send_filter(peer)
+        # The peer listens on the port it announced at the address it
+        # connected from.  Tell a few other peers about it if it is new.
+        port = msg.get('port')
+        if peer.remote_host is not None and isinstance(port, int) and 0 < port < 65536:
+            peer.listen_addr = (peer.remote_host, port)
+            self._dht_seen(peer)
+            if not peer.rpc_only and self.peer_table.add(peer.listen_addr, source=peer.remote_host):
+                self._relay_addrs([list(peer.listen_addr)], peer)
+        return peer
+
+    def _register_peer(self, address: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                       codec: Codec, outbound: bool) -> Optional[PeerConnection]:
+        """Create the connection object for a completed handshake and start its writer.
+
+        Returns ``None`` if the new connection duplicates an existing
+        one to the same node and is not the one to keep.
+        """
+        existing = self.peers.get(address)
+        if existing is not None and not existing.closed:
+            # Both nodes dialled each other.  Keep the connection opened
+            # by the node with the smaller address so both sides agree.
+            keep_outbound = self.address < address
+            if outbound != keep_outbound or existing.outbound == keep_outbound:
+                print(f"Dropping duplicate connection to peer {address}")
+                return None
+            existing.close()
+        if not self._admit(address, outbound):
+            return None
+        peer = PeerConnection(address, reader, writer, codec, outbound, max_queue=self.max_send_queue,
+                              overflow_policy=self.overflow_policy, send_timeout=self.send_timeout,
+                              max_batch_bytes=self.write_batch_bytes, batch_delay=self.write_batch_delay)
+        peer.query_limiter = RateLimiter(self.peer_query_rate, self.peer_query_burst, self.peer_byte_rate,
+                                         self.peer_byte_burst)
+        peer.start()
+        self.peers[address] = peer
+        if self.time_to_first_peer is None and self._started_at is not None:
+            self.time_to_first_peer = time.monotonic() - self._started_at
+        return peer
+
+    def _rpc_connection(self, address: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                        codec: Codec, outbound: bool) -> PeerConnection:
+        """Create an RPC-only connection and start its writer.
+
+        It is kept in ``rpc_connections`` rather than ``peers``, so
+        admission control and eviction never see it.
+        """
+        peer = PeerConnection(address, reader, writer, codec, outbound, max_queue=self.max_send_queue,
+                              overflow_policy=self.overflow_policy, send_timeout=self.send_timeout)
+        peer.rpc_only = True
+        if not outbound:
+            peer.query_limiter = self.rpc_query_limiter
+        peer.start()
+        self.rpc_connections.add(peer)
+        return peer
+
+    def _admit(self, address: str, outbound: bool) -> bool:
+        """Make room for a new peer connection.
+
+        Only inbound peers are evicted; a full outbound side refuses
+        the new connection, as evicting an outbound peer would just
+        make the connection manager dial a replacement.
+
+        :returns: ``False`` if the connection has to be refused.
+        """
+        connected = [peer for peer in self.peers.values() if peer.outbound == outbound and not peer.closed]
+        if len(connected) < (self.max_outbound if outbound else self.max_inbound):
+            return True
+        direction = 'outbound' if outbound else 'inbound'
+        victim = None if outbound else self._eviction_candidate(connected)
+        if victim is None:
+            print(f"Refusing {direction} connection to peer {address}: connection limit reached")
+            self.connections_rejected += 1
+            return False
+        print(f"Evicting {direction} peer {victim.address} to make room for {address}")
+        self.connections_evicted += 1
+        victim.evicted = True
+        victim.close()
+        return True
+
+    def _eviction_candidate(self, peers: List[PeerConnection]) -> Optional[PeerConnection]:
+        """Return the lowest scored of ``peers``, or ``None`` if all are protected."""
+        persistent = {state.peer_id for state in self.dial_states.values() if state.persistent}
+        candidates = [peer for peer in peers if peer.address not in persistent]
+        fast = sorted((peer for peer in candidates if peer.rtt.srtt is not None), key=lambda peer: peer.rtt.srtt)
+        useful = sorted((peer for peer in candidates if peer.answers), key=lambda peer: -peer.last_answer)
+        protected = {id(peer) for peer in fast[:EVICT_PROTECT_FAST] + useful[:EVICT_PROTECT_USEFUL]}
+        candidates = [peer for peer in candidates if id(peer) not in protected]
+        if not candidates:
+            return None
+        # Many connections from one network are more likely to come
+        # from a single operator; thin out the largest group first.
+        groups: Dict[str, List[PeerConnection]] = collections.defaultdict(list)
+        for peer in candidates:
+            groups[network_group(peer.remote_host) if peer.remote_host else peer.address].append(peer)
+        group = max(groups.values(), key=len)
+        return min(group, key=lambda peer: (peer.answers, -peer.connected_at))
 
     async def _handle_incoming(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-        """Handle a new inbound connection by performing a handshake."""
-        peer_id = await self._incoming_handshake(reader, writer)
-        if peer_id is None:
+        """Handle a new inbound connection by performing a handshake.
+
+        Connections beyond ``max_inbound`` concurrent handshakes are
+        closed at once and handshakes that take longer than
+        ``handshake_timeout`` are abandoned.
+        """
+        if self._handshaking >= self.max_inbound:
+            self.connections_rejected += 1
+            writer.close()
+            return
+        self._handshaking += 1
+        try:
+            peer = await asyncio.wait_for(self._incoming_handshake(reader, writer), self.handshake_timeout)
+        except asyncio.TimeoutError:
+            print(f"Inbound handshake from {writer.get_extra_info('peername')} timed out")
+            self.handshake_timeouts += 1
+            peer = None
+        finally:
+            self._handshaking -= 1
+        if peer is None:
             writer.close()
             await writer.wait_closed()
             return
         # Launch a reader for this connection.
-        await self._peer_reader(peer_id, reader, writer)
+        if peer.rpc_only:
+            await self._rpc_reader(peer)
+        else:
+            await self._peer_reader(peer)
+
+    async def _rpc_reader(self, peer: PeerConnection) -> None:
+        """Handle the ``rpc`` and ``rpc_reply`` messages of an RPC-only connection until it closes.
 
-    async def _peer_reader(self, peer_id: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        RPC-only connections get no keepalive, so one that stays idle
+        for ``rpc_timeout`` seconds while no request on it is being
+        answered is closed.
+        """
+        # One read stays outstanding across timeouts; cancelling it
+        # halfway through a frame would lose the stream's framing.
+        read: Optional[asyncio.Task] = None
+        try:
+            while True:
+                if read is None:
+                    read = self.loop.create_task(self._read_message(peer.reader, peer.codec))
+                done, _ = await asyncio.wait({read}, timeout=self.rpc_timeout)
+                if not done:
+                    if peer.inflight:
+                        continue
+                    print(f"Closing idle RPC connection {peer.address}")
+                    break
+                msg = read.result()
+                read = None
+                if not msg:
+                    break
+                mtype = msg.get('type')
+                if mtype == 'rpc':
+                    await self._handle_rpc(msg, peer)
+                elif mtype == 'rpc_reply':
+                    await self._handle_rpc_reply(msg, peer)
+        except Exception as exc:
+            print(f"Error while reading from RPC connection {peer.address}: {exc}")
+        finally:
+            if read is not None:
+                read.cancel()
+            self.rpc_connections.discard(peer)
+            peer.close()
+            for waiter_peer, future in self.rpc_waiters.values():
+                if waiter_peer is peer and not future.done():
+                    future.set_result(None)
+
+    async def _peer_reader(self, peer: PeerConnection) -> None:
         """Continuously read and dispatch messages from a connected peer."""
+        peer_id = peer.address
         try:
             while True:
-                msg = await self._read_message(reader)
+                msg = await self._read_message(peer.reader, peer.codec)
                 if not msg:
                     break
                 await self._dispatch_message(msg, peer_id)
@@ -303,99 +2009,447 @@ class P2PNetwork:
             print(f"Error while reading from peer {peer_id}: {exc}")
         finally:
             # Remove peer on disconnect.
-            if peer_id in self.peers:
+            if self.peers.get(peer_id) is peer:
                 del self.peers[peer_id]
-            writer.close()
-            await writer.wait_closed()
+            peer.close()
             print(f"Disconnected from peer {peer_id}")
+            self._peer_lost(peer)
+            if peer_id not in self.peers:
+                for pending in list(self.pending_queries.values()):
+                    pending.peer_lost(peer_id)
+                self._downstream_lost(peer_id)
+                self.response_latency.pop(peer_id, None)
+            for waiter_peer, future in self.rpc_waiters.values():
+                if waiter_peer is peer and not future.done():
+                    future.set_result(None)
 
     async def _dispatch_message(self, msg: Dict[str, object], sender_peer: str) -> None:
-        """Handle an incoming message based on its type."""
+        """Handle an incoming message based on its type.
+
+        Handlers return quickly: answering a query happens in a
+        separate task so the reader can move on to the next message.
+        New queries over the rate limits are refused with ``busy``
+        before any work is done for them.
+        """
         mtype = msg.get('type')
         if mtype == 'query':
+            qid = msg.get('id')
+            peer = self.peers.get(sender_peer)
+            if isinstance(qid, str) and qid not in self.processed_queries and not self._within_rate(msg, peer):
+                if peer is not None:
+                    peer.busy_replies += 1
+                    peer.send({'type': 'busy', 'id': qid, 'from': self.address})
+                return
             await self._handle_query(msg, sender_peer)
-        elif mtype == 'response':
+        elif mtype in ('response', 'ack', 'dup', 'busy'):
             await self._handle_response(msg, sender_peer)
+        elif mtype == 'cancel':
+            await self._handle_cancel(msg, sender_peer)
+        elif mtype == 'ping':
+            await self._handle_ping(msg, sender_peer)
+        elif mtype == 'pong':
+            await self._handle_pong(msg, sender_peer)
+        elif mtype == 'rpc':
+            await self._handle_rpc(msg, self.peers.get(sender_peer))
+        elif mtype == 'rpc_reply':
+            await self._handle_rpc_reply(msg, self.peers.get(sender_peer))
+        elif mtype == 'filter':
+            await self._handle_filter(msg, sender_peer)
+        elif mtype == 'getaddr':
+            await self._handle_getaddr(msg, sender_peer)
+        elif mtype == 'addr':
+            await self._handle_addr(msg, sender_peer)
         # Unknown message types are ignored.
 
+    def _within_rate(self, msg: Dict[str, object], peer: Optional[PeerConnection]) -> bool:
+        """Charge a query to its sender's and the global rate limits.
+
+        :returns: ``False``, charging nothing, if either limit is
+            exceeded.
+        """
+        if peer is None:
+            return False
+        payload = msg.get('payload')
+        size = len(payload.encode('utf-8')) if isinstance(payload, str) else 0
+        now = time.monotonic()
+        if peer.query_limiter.check(size, now) is not None:
+            self.queries_rate_limited['peer'] += 1
+            return False
+        if self.query_limiter.check(size, now) is not None:
+            self.queries_rate_limited['global'] += 1
+            return False
+        peer.query_limiter.consume(size)
+        self.query_limiter.consume(size)
+        return True
+
     async def _handle_query(self, msg: Dict[str, object], sender_peer: str) -> None:
         """Process an inbound query message.
 
-        If this node has already processed the query the message is
-        ignored.  Otherwise the query is forwarded to all other peers,
-        the callback is invoked to obtain a local result and a
-        response message is sent back to the sender.
+        If this node has already processed the query a ``dup`` is sent
+        back, and if the sender already has ``max_inflight_per_peer``
+        queries in progress a ``busy``.  Otherwise, unless its ``ttl``
+        is used up, the query is forwarded to all other peers and
+        acknowledged with an ``ack``, and a task is started that invokes
+        the callback and sends the response back to the sender.
         """
         qid = msg.get('id')  # type: ignore
-        origin = msg.get('origin')  # type: ignore
         query = msg.get('payload')  # type: ignore
-        if not isinstance(qid, str) or not isinstance(query, str):
+        upstream = self.peers.get(sender_peer)
+        if not isinstance(qid, str) or not isinstance(query, str) or upstream is None:
             return
-        # Skip if we've already seen this query.
+        # Skip if we've already seen this query, telling the sender so
+        # that its origin stops waiting for an answer from us.
         if qid in self.processed_queries:
+            upstream.send({'type': 'dup', 'id': qid, 'from': self.address})
+            return
+        if len(upstream.inflight) >= self.max_inflight_per_peer:
+            upstream.busy_replies += 1
+            upstream.send({'type': 'busy', 'id': qid, 'from': self.address})
             return
         self.processed_queries.add(qid)
-        # Forward to all peers except the sender.
-        for peer_id, writer in list(self.peers.items()):
-            if peer_id == sender_peer:
-                continue
-            try:
-                await self._send_message(writer, msg)
-            except Exception as exc:
-                print(f"Error forwarding query to peer {peer_id}: {exc}")
-        # Process locally via callback.
-        try:
-            result = self.on_query(query)
-            # Await if the callback is async.
-            if asyncio.iscoroutine(result):
-                result = await result
-        except Exception as exc:
-            result = {'error': str(exc)}
+        ttl = msg.get('ttl', self.default_ttl)
+        if not isinstance(ttl, int):
+            ttl = self.default_ttl
+        ttl = min(ttl, self.max_ttl)
+        # Remember where the query came from so replies and a cancel
+        # from the origin can be matched to it.
+        self.reverse_paths[qid] = sender_peer
+        # Forward to all peers except the sender while hops remain.
+        # The ack is queued before control returns to the loop so it
+        # reaches the sender ahead of any reply relayed from downstream.
+        if ttl > 1:
+            forward = dict(msg, ttl=ttl - 1)
+            others = [peer for peer_id, peer in self.peers.items() if peer_id != sender_peer]
+            sent = self._broadcast(forward, self._select_fanout(self._matching_peers(others, terms(query), ttl - 1)))
+            self.query_messages_sent += len(sent)
+            if sent:
+                # Each peer owes its own reply until it acks more.
+                self.forward_paths[qid] = {peer.address: 1 for peer in sent}
+                upstream.send({'type': 'ack', 'id': qid, 'from': self.address, 'forwarded': len(sent)})
+        # Answer in a tracked task so the reader is not held up.
+        task = self.loop.create_task(self._answer_query(qid, query, sender_peer))
+        upstream.inflight.add(task)
+        task.add_done_callback(upstream.inflight.discard)
+        self.query_tasks[qid] = task
+        task.add_done_callback(lambda _task: self.query_tasks.pop(qid, None))
+
+    async def _answer_query(self, qid: str, query: str, sender_peer: str) -> None:
+        """Invoke the callback for a query and send the response upstream."""
+        result = await self._run_callback(qid, query)
+        if qid in self.cancelled_queries:
+            return
         # Build response and send it back to the sender.  The sender
-        # will propagate it towards the originator.
+        # will relay it towards the originator.
         resp_msg = {
             'type': 'response',
             'id': qid,
             'from': self.address,
             'response': result,
         }
-        writer = self.peers.get(sender_peer)
-        if writer is not None:
+        peer = self.peers.get(sender_peer)
+        if peer is not None:
+            self._send_answer(peer, resp_msg)
+
+    def _send_answer(self, peer: PeerConnection, message: Dict[str, object]) -> None:
+        """Send a ``response`` or ``rpc_reply`` carrying a callback result.
+
+        A result the codec cannot encode, e.g. because it is not
+        serialisable or exceeds the frame size, is replaced with an
+        error so the origin still hears back from this node.
+        """
+        try:
+            peer.send(message)
+        except Exception as exc:
+            print(f"Error sending {message.get('type')} to peer {peer.address}: {exc}")
+            peer.send(dict(message, response={'error': f"response could not be encoded: {exc}"}))
+
+    async def _run_callback(self, qid: str, query: str) -> object:
+        """Run ``on_query`` within the concurrency limit.
+
+        Queries cancelled while waiting for a free slot are skipped.
+        Exceptions raised by the callback become an error result.  A
+        callback running on the executor cannot be interrupted, so it
+        keeps its slot until it returns even if the query is cancelled
+        meanwhile.
+        """
+        self.callbacks_waiting += 1
+        try:
+            await self._callback_slots.acquire()
+        finally:
+            self.callbacks_waiting -= 1
+        if qid in self.cancelled_queries:
+            self.callbacks_skipped += 1
+            self._callback_slots.release()
+            return None
+        self.callbacks_running += 1
+        if self.callback_mode == 'executor':
+            future = self.loop.run_in_executor(self.callback_executor, _invoke_callback, self.on_query, query)
+            future.add_done_callback(self._callback_done)
             try:
-                await self._send_message(writer, resp_msg)
+                return await asyncio.shield(future)
             except Exception as exc:
-                print(f"Error sending response to peer {sender_peer}: {exc}")
+                return {'error': str(exc)}
+        try:
+            result = self.on_query(query)
+            # Await if the callback is async.
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        except Exception as exc:
+            return {'error': str(exc)}
+        finally:
+            self._callback_done()
+
+    def _callback_done(self, future: Optional[asyncio.Future] = None) -> None:
+        """Free the slot of a callback that returned."""
+        if future is not None and not future.cancelled():
+            # Retrieve the exception of a callback nobody waits for any more.
+            future.exception()
+        self.callbacks_running -= 1
+        self.callbacks_completed += 1
+        self._callback_slots.release()
 
     async def _handle_response(self, msg: Dict[str, object], peer_id: str) -> None:
-        """Handle an inbound response message for a pending query."""
+        """Handle an inbound ``response``, ``ack`` or ``dup`` message.
+
+        Replies to queries this node originated update the pending
+        aggregator.  Replies to queries it forwarded are relayed to the
+        peer the query came from.  Anything else is dropped.
+        """
         qid = msg.get('id')  # type: ignore
         if not isinstance(qid, str):
             return
-        agg = self.pending_queries.get(qid)
-        if agg is None:
+        pending = self.pending_queries.get(qid)
+        sender = self.peers.get(peer_id)
+        if sender is not None and msg.get('type') == 'response' and (pending is not None or qid in self.reverse_paths):
+            sender.answers += 1
+            sender.last_answer = time.monotonic()
+        if pending is None:
+            if qid in self.cancelled_queries:
+                return
+            self._count_relayed(qid, msg, peer_id)
+            upstream_id = self.reverse_paths.get(qid)
+            upstream = self.peers.get(upstream_id) if upstream_id is not None else None
+            if upstream is not None:
+                upstream.send(msg)
             return
-        # Append the response along with the address of the peer that sent it.
-        response_payload = msg.get('response')
-        agg['responses'].append(response_payload)
-        agg['remaining'] -= 1
-        if agg['remaining'] <= 0:
-            agg['event'].set()
-
-    async def _send_message(self, writer: asyncio.StreamWriter, message: Dict[str, object]) -> None:
-        """Serialize and send a single JSON message to a peer."""
-        data = json.dumps(message).encode('utf-8') + b'\n'
-        writer.write(data)
+        if peer_id in pending.superseded:
+            return
+        mtype = msg.get('type')
+        if mtype == 'ack':
+            forwarded = msg.get('forwarded')
+            if isinstance(forwarded, int) and forwarded > 0:
+                pending.expect(forwarded, via=peer_id)
+        elif mtype == 'response':
+            self._record_latency(peer_id, time.monotonic() - pending.started)
+            pending.add_response(msg.get('response'), via=peer_id)
+            if peer_id in pending.rivals:
+                self._supersede(pending, peer_id)
+        else:
+            pending.resolve(via=peer_id)
+
+    def _count_relayed(self, qid: str, msg: Dict[str, object], peer_id: str) -> None:
+        """Update the replies still expected through ``peer_id`` for a query this node forwarded."""
+        downstream = self.forward_paths.get(qid)
+        if downstream is None or peer_id not in downstream:
+            return
+        if msg.get('type') == 'ack':
+            forwarded = msg.get('forwarded')
+            if isinstance(forwarded, int) and forwarded > 0:
+                downstream[peer_id] += forwarded
+            return
+        downstream[peer_id] -= 1
+        if downstream[peer_id] <= 0:
+            del downstream[peer_id]
+
+    def _downstream_lost(self, peer_id: str) -> None:
+        """Write off the relayed replies a disconnected peer still owed.
+
+        For each query forwarded to ``peer_id`` the node it came from
+        gets one ``dup`` per missing reply, so the origin does not wait
+        for them until its timeout.
+        """
+        for qid, downstream in self.forward_paths.items():
+            missing = downstream.pop(peer_id, 0)
+            if not missing or qid in self.cancelled_queries:
+                continue
+            upstream_id = self.reverse_paths.get(qid)
+            upstream = self.peers.get(upstream_id) if upstream_id is not None else None
+            if upstream is not None:
+                for _ in range(missing):
+                    upstream.send({'type': 'dup', 'id': qid, 'from': peer_id})
+
+    async def _handle_cancel(self, msg: Dict[str, object], sender_peer: str) -> None:
+        """Handle a ``cancel`` for a query this node received.
+
+        Only the peer the query arrived from may cancel it.  The cancel
+        is passed on to the peers the query was forwarded to.
+        """
+        qid = msg.get('id')  # type: ignore
+        if not isinstance(qid, str) or self.reverse_paths.get(qid) != sender_peer:
+            return
+        self.cancelled_queries[qid] = True
+        task = self.query_tasks.get(qid)
+        if task is not None:
+            task.cancel()
+        downstream = self.forward_paths.pop(qid) or {}
+        self._broadcast(msg, [self.peers[peer_id] for peer_id in downstream if peer_id in self.peers])
+
+    async def _handle_ping(self, msg: Dict[str, object], sender_peer: str) -> None:
+        """Answer a ``ping`` with a ``pong`` echoing its nonce."""
+        peer = self.peers.get(sender_peer)
+        if peer is not None:
+            peer.send({'type': 'pong', 'nonce': msg.get('nonce')})
+
+    async def _handle_pong(self, msg: Dict[str, object], sender_peer: str) -> None:
+        """Match a ``pong`` to the outstanding ``ping`` and record the round trip."""
+        peer = self.peers.get(sender_peer)
+        if peer is None or peer.ping_nonce is None or msg.get('nonce') != peer.ping_nonce:
+            return
+        peer.rtt.update(time.monotonic() - peer.ping_sent_at)
+        peer.ping_nonce = None
+
+    async def _handle_rpc(self, msg: Dict[str, object], peer: Optional[PeerConnection]) -> None:
+        """Answer a DHT request arriving on ``peer``.
+
+        ``query`` requests are answered from a separate task, subject
+        to the same per peer limit as flooded queries.
+        """
+        rpc_id = msg.get('rpc_id')
+        if peer is None or not isinstance(rpc_id, str):
+            return
+        self._dht_seen(peer)
+        method = msg.get('method')
+        reply: Dict[str, object] = {'type': 'rpc_reply', 'rpc_id': rpc_id}
+        if method in ('find_node', 'find_value'):
+            key = msg.get('key')
+            if method == 'find_value' and isinstance(key, str):
+                if key in self.dht_values:
+                    reply['value'] = self.dht_values.get(key)
+                target: Optional[int] = key_id(key)
+            else:
+                try:
+                    target = int(str(msg.get('target')), 16)
+                except ValueError:
+                    target = None
+            if 'value' not in reply and target is not None:
+                contacts = self.routing_table.closest(target, K, exclude={node_id(peer.address)})
+                reply['contacts'] = [contact.to_wire() for contact in contacts]
+        elif method == 'store':
+            key = msg.get('key')
+            if not isinstance(key, str) or not _storable(key, msg.get('value')):
+                reply['error'] = 'invalid or oversized value'
+            else:
+                self.dht_values[key] = msg.get('value')
+                reply['ok'] = True
+        elif method == 'query':
+            payload = msg.get('payload')
+            if not isinstance(payload, str):
+                return
+            if len(peer.inflight) >= self.max_inflight_per_peer or not self._within_rate(msg, peer):
+                peer.busy_replies += 1
+                reply['error'] = 'busy'
+            else:
+                task = self.loop.create_task(self._answer_rpc_query(rpc_id, payload, peer))
+                peer.inflight.add(task)
+                task.add_done_callback(peer.inflight.discard)
+                return
+        else:
+            reply['error'] = f"unknown method {method!r}"
+        peer.send(reply)
+
+    async def _answer_rpc_query(self, rpc_id: str, query: str, peer: PeerConnection) -> None:
+        """Invoke the callback for a directed query and reply to the requester."""
+        result = await self._run_callback(rpc_id, query)
+        self._send_answer(peer, {'type': 'rpc_reply', 'rpc_id': rpc_id, 'response': result})
+
+    async def _handle_rpc_reply(self, msg: Dict[str, object], peer: Optional[PeerConnection]) -> None:
+        """Hand a DHT reply to the request waiting for it on ``peer``."""
+        rpc_id = msg.get('rpc_id')
+        waiter = self.rpc_waiters.get(rpc_id) if isinstance(rpc_id, str) else None
+        if peer is None or waiter is None or waiter[0] is not peer:
+            return
+        self._dht_seen(peer)
+        if not waiter[1].done():
+            waiter[1].set_result(msg)
+
+    async def _handle_filter(self, msg: Dict[str, object], sender_peer: str) -> None:
+        """Replace a peer's content filter with the one it sent."""
+        peer = self.peers.get(sender_peer)
+        if peer is not None:
+            self._set_peer_filter(peer, msg.get('filter'))
+
+    async def _handle_getaddr(self, msg: Dict[str, object], sender_peer: str) -> None:
+        """Reply to a ``getaddr`` with a random sample of known addresses.
+
+        Each connection gets one answer so a peer cannot enumerate the
+        whole table by asking repeatedly.
+        """
+        peer = self.peers.get(sender_peer)
+        if peer is None or peer.getaddr_answered:
+            return
+        peer.getaddr_answered = True
+        addrs = [list(addr) for addr in self.peer_table.sample(MAX_ADDR_SEND) if addr != peer.listen_addr]
+        peer.send({'type': 'addr', 'addrs': addrs})
+
+    async def _handle_addr(self, msg: Dict[str, object], sender_peer: str) -> None:
+        """Add the addresses in an ``addr`` message to the peer table.
+
+        Entries that were new to this node are relayed onwards if the
+        message was small, i.e. an announcement rather than a
+        ``getaddr`` reply.
+        """
+        peer = self.peers.get(sender_peer)
+        addrs = msg.get('addrs')
+        if peer is None or not isinstance(addrs, list) or len(addrs) > MAX_ADDR_SEND:
+            return
+        learned = []
+        for entry in addrs:
+            if not isinstance(entry, list) or len(entry) != 2:
+                continue
+            host, port = entry
+            if not isinstance(host, str) or not isinstance(port, int) or not 0 < port < 65536:
+                continue
+            if (host, port) in self._self_addrs:
+                continue
+            if self.peer_table.add((host, port), source=peer.remote_host):
+                learned.append([host, port])
+        if learned and len(addrs) <= ADDR_RELAY_MAX:
+            self._relay_addrs(learned, peer)
+
+    def _relay_addrs(self, addrs: List[List[object]], source: PeerConnection) -> None:
+        """Announce ``addrs`` to a few random peers other than ``source``."""
+        others = [peer for peer in self.peers.values() if peer is not source]
+        targets = random.sample(others, min(ADDR_RELAY_FANOUT, len(others)))
+        self._broadcast({'type': 'addr', 'addrs': addrs}, targets)
+
+    def _broadcast(self, message: Dict[str, object], peers: List[PeerConnection]) -> List[PeerConnection]:
+        """Queue a message on several peers' connections.
+
+        Returns the peers that accepted the message; peers whose send
+        queue overflowed or that have disconnected are left out.
+        """
+        sent = []
+        for peer in peers:
+            try:
+                if peer.send(message):
+                    sent.append(peer)
+            except Exception as exc:
+                print(f"Error sending {message.get('type')} to peer {peer.address}: {exc}")
+        return sent
+
+    async def _send_message(self, writer: asyncio.StreamWriter, message: Dict[str, object], codec: Codec = JSONL) -> None:
+        """Encode and write a single message directly to a stream.
+
+        Only used during the handshake, before the peer's
+        :class:`PeerConnection` and its writer task exist.
+        """
+        writer.write(codec.encode(message))
         await writer.drain()
 
-    async def _read_message(self, reader: asyncio.StreamReader) -> Dict[str, object]:
-        """Read a single newline‑terminated JSON message from a peer."""
-        try:
-            line = await reader.readline()
-        except Exception:
-            return {}
-        if not line:
-            return {}
-        try:
-            return json.loads(line.decode('utf-8'))
-        except Exception:
-            return {}
\ No newline at end of file
+    async def _read_message(self, reader: asyncio.StreamReader, codec: Codec = JSONL) -> Dict[str, object]:
+        """Read a single message from a peer.
+
+        Returns an empty dict on EOF or if the message cannot be decoded.
+        """
+        return await codec.read(reader)
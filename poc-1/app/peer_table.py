@@ -0,0 +1,218 @@
+"""
+peer_table.py
+~~~~~~~~~~~~~
+
+A table of known peer addresses modelled on Bitcoin Core's address
+manager ("addrman").  Addresses learned from ``addr`` gossip or from
+bootstrap configuration go into the *new* table.  Once a connection to
+an address succeeds it moves to the *tried* table.  Both tables are
+split into buckets and each address can only live in the bucket and
+slot chosen by hashing it with a secret key.  Because the bucket of a
+*new* address also depends on the network group of the peer that told
+us about it, a single peer (or a single /16) can only fill a small
+part of the table, which makes it hard to surround a node with
+attacker controlled addresses.
+
+When the connection manager needs an address it picks the tried or
+new table with equal probability and then a random entry, accepting
+it with a probability that falls with every failed connection
+attempt.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import ipaddress
+import random
+import secrets
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+Address = Tuple[str, int]
+
+# An entry that failed this many attempts in a row without ever
+# succeeding is considered useless and may be overwritten.
+MAX_FAILURES = 10
+
+
+class PeerEntry:
+    """What the table knows about a single address."""
+
+    def __init__(self, addr: Address, source_group: str):
+        self.addr = addr
+        self.source_group = source_group
+        self.last_seen = time.time()
+        self.last_try = 0.0
+        self.last_success = 0.0
+        self.attempts = 0
+        self.tried = False
+
+    def is_terrible(self) -> bool:
+        """Return ``True`` if the entry is not worth keeping."""
+        return self.attempts >= MAX_FAILURES and self.last_success == 0.0
+
+    def chance(self, now: float) -> float:
+        """Relative chance of selecting this entry, as in addrman's GetChance."""
+        chance = 0.66 ** min(self.attempts, 8)
+        if now - self.last_try < 600:
+            chance *= 0.01
+        return chance
+
+
+def network_group(host: str) -> str:
+    """Group hosts that are likely under common control.
+
+    IPv4 addresses are grouped by /16 and IPv6 addresses by /32, as in
+    Bitcoin.  Host names, e.g. docker service names, form their own
+    group.
+    """
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        return host.lower()
+    prefix = 16 if ip.version == 4 else 32
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+
+class PeerTable:
+    """Bucketed table of known peer addresses.
+
+    :param new_buckets: Number of buckets in the new table.
+    :param tried_buckets: Number of buckets in the tried table.
+    :param bucket_size: Slots per bucket.
+    """
+
+    def __init__(self, new_buckets: int = 64, tried_buckets: int = 16, bucket_size: int = 32):
+        self.new_buckets = new_buckets
+        self.tried_buckets = tried_buckets
+        self.bucket_size = bucket_size
+        self._key = secrets.token_bytes(16)
+        self._entries: Dict[Address, PeerEntry] = {}
+        # (bucket, slot) -> address for each table.
+        self._new: Dict[Tuple[int, int], Address] = {}
+        self._tried: Dict[Tuple[int, int], Address] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, addr: object) -> bool:
+        return addr in self._entries
+
+    def add(self, addr: Address, source: Optional[str] = None) -> bool:
+        """Learn about ``addr`` from the host ``source``.
+
+        :returns: ``True`` if the address was not known before and was
+            stored.
+        """
+        entry = self._entries.get(addr)
+        if entry is not None:
+            entry.last_seen = time.time()
+            return False
+        entry = PeerEntry(addr, network_group(source or addr[0]))
+        position = self._new_position(entry)
+        occupant = self._new.get(position)
+        if occupant is not None:
+            if not self._entries[occupant].is_terrible():
+                return False
+            self._remove(occupant)
+        self._entries[addr] = entry
+        self._new[position] = addr
+        return True
+
+    def mark_attempt(self, addr: Address) -> None:
+        """Record that a connection to ``addr`` is being attempted."""
+        entry = self._entries.get(addr)
+        if entry is not None:
+            entry.last_try = time.time()
+            entry.attempts += 1
+
+    def mark_good(self, addr: Address) -> None:
+        """Record a successful connection and move ``addr`` to the tried table."""
+        entry = self._entries.get(addr)
+        if entry is None:
+            self.add(addr)
+            entry = self._entries.get(addr)
+            if entry is None:
+                return
+        now = time.time()
+        entry.last_success = entry.last_seen = entry.last_try = now
+        entry.attempts = 0
+        if entry.tried:
+            return
+        self._drop_position(entry)
+        position = self._tried_position(entry)
+        occupant = self._tried.get(position)
+        if occupant is not None:
+            # Make room by moving the current occupant back to new.
+            evicted = self._entries[occupant]
+            del self._tried[position]
+            evicted.tried = False
+            new_position = self._new_position(evicted)
+            if new_position in self._new:
+                self._remove(self._new[new_position])
+            self._new[new_position] = occupant
+        entry.tried = True
+        self._tried[position] = entry.addr
+
+    def remove(self, addr: Address) -> None:
+        """Forget ``addr``, e.g. because it turned out to be this node."""
+        if addr in self._entries:
+            self._remove(addr)
+
+    def select(self, exclude: Set[Address]) -> Optional[Address]:
+        """Pick an address to connect to, or ``None`` if there is none.
+
+        Tried and new entries are equally likely to be chosen; within a
+        table entries with recent failures are less likely.
+        """
+        candidates = [addr for addr in self._entries if addr not in exclude]
+        if not candidates:
+            return None
+        tried = [addr for addr in candidates if self._entries[addr].tried]
+        new = [addr for addr in candidates if not self._entries[addr].tried]
+        pool = tried if tried and (not new or random.random() < 0.5) else new
+        now = time.time()
+        factor = 1.0
+        for _ in range(1000):
+            addr = random.choice(pool)
+            if random.random() < factor * self._entries[addr].chance(now):
+                return addr
+            factor *= 1.2
+        return random.choice(pool)
+
+    def sample(self, count: int) -> List[Address]:
+        """Return up to ``count`` random addresses for an ``addr`` reply."""
+        usable = [addr for addr, entry in self._entries.items() if not entry.is_terrible()]
+        return random.sample(usable, min(count, len(usable)))
+
+    def stats(self) -> Dict[str, object]:
+        """Return table occupancy for monitoring."""
+        tried = sum(1 for entry in self._entries.values() if entry.tried)
+        return {
+            'known': len(self._entries),
+            'tried': tried,
+            'new': len(self._entries) - tried,
+        }
+
+    def _hash(self, *parts: object) -> int:
+        data = b'|'.join(str(part).encode('utf-8') for part in parts)
+        return int.from_bytes(hashlib.blake2b(data, key=self._key, digest_size=8).digest(), 'big')
+
+    def _new_position(self, entry: PeerEntry) -> Tuple[int, int]:
+        group = network_group(entry.addr[0])
+        bucket = self._hash('new', entry.source_group, group) % self.new_buckets
+        return bucket, self._hash('slot', bucket, *entry.addr) % self.bucket_size
+
+    def _tried_position(self, entry: PeerEntry) -> Tuple[int, int]:
+        bucket = self._hash('tried', network_group(entry.addr[0]), *entry.addr) % self.tried_buckets
+        return bucket, self._hash('slot', bucket, *entry.addr) % self.bucket_size
+
+    def _drop_position(self, entry: PeerEntry) -> None:
+        table = self._tried if entry.tried else self._new
+        for position, addr in list(table.items()):
+            if addr == entry.addr:
+                del table[position]
+
+    def _remove(self, addr: Address) -> None:
+        entry = self._entries.pop(addr)
+        self._drop_position(entry)
@@ -0,0 +1,71 @@
+"""
+policies.py
+~~~~~~~~~~~
+
+Completion policies for peer queries.  By default
+:meth:`network.P2PNetwork.query_peers` waits until every node the
+query reached has replied or the timeout expires.  Most callers only
+need a few good answers; a policy lets them stop as soon as they have
+them, after which the remaining peers are told to cancel their work.
+
+A policy looks at the responses received so far and says whether the
+query is complete.  Policies hold no per‑query state so a single
+instance can be shared between queries.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, List
+
+
+class CompletionPolicy:
+    """Wait for every reply; the default behaviour."""
+
+    def satisfied(self, responses: List[object]) -> bool:
+        """Return ``True`` once ``responses`` are enough to stop waiting."""
+        return False
+
+
+class FirstResponses(CompletionPolicy):
+    """Complete once ``count`` responses have arrived.
+
+    :param count: Number of responses required.
+    """
+
+    def __init__(self, count: int = 1):
+        if count < 1:
+            raise ValueError("count must be at least 1")
+        self.count = count
+
+    def satisfied(self, responses: List[object]) -> bool:
+        return len(responses) >= self.count
+
+
+class ScoreThreshold(CompletionPolicy):
+    """Complete once ``count`` responses score at least ``threshold``.
+
+    :param score: Function rating a single response.
+    :param threshold: Minimum score for a response to count.
+    :param count: Number of qualifying responses required.
+    """
+
+    def __init__(self, score: Callable[[object], float], threshold: float, count: int = 1):
+        if count < 1:
+            raise ValueError("count must be at least 1")
+        self.score = score
+        self.threshold = threshold
+        self.count = count
+
+    def satisfied(self, responses: List[object]) -> bool:
+        good = 0
+        for response in responses:
+            try:
+                if self.score(response) >= self.threshold:
+                    good += 1
+            except Exception:
+                continue
+        return good >= self.count
+
+
+ALL_RESPONSES = CompletionPolicy()
+FIRST_RESPONSE = FirstResponses(1)
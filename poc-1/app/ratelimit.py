@@ -0,0 +1,102 @@
+"""
+ratelimit.py
+~~~~~~~~~~~~
+
+Token bucket rate limits for inbound queries.
+
+Every query a node accepts is forwarded and answered by the LLM behind
+``on_query``, so a peer sending queries as fast as it can would tie
+up the whole node.  A :class:`TokenBucket` holds up to ``burst``
+tokens and gains ``rate`` tokens per second; a query is accepted only
+if enough tokens are left and then consumes them.  Short bursts are
+absorbed while the long term rate stays bounded.
+
+:class:`RateLimiter` pairs a bucket counting queries with one counting
+query bytes.  The network keeps one per peer and one for all peers
+together.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Dict, Optional
+
+# Reasons reported when a query is refused.
+QUERIES = 'queries'
+BYTES = 'bytes'
+
+
+class TokenBucket:
+    """A bucket of ``burst`` tokens refilled at ``rate`` tokens per second.
+
+    :param rate: Tokens added per second.
+    :param burst: Capacity of the bucket, which starts full.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def available(self, now: Optional[float] = None) -> float:
+        """Return the number of tokens after refilling up to ``now``."""
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def consume(self, amount: float) -> None:
+        """Remove ``amount`` tokens; check :meth:`available` first."""
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """Limits on the number and the size of queries.
+
+    A rate of ``None`` disables that limit.  Bursts default to one
+    second's worth of tokens.
+
+    :param query_rate: Queries per second.
+    :param query_burst: Queries accepted at once after a quiet period.
+    :param byte_rate: Bytes of query text per second.
+    :param byte_burst: Bytes accepted at once after a quiet period.
+    """
+
+    def __init__(self, query_rate: Optional[float] = None, query_burst: Optional[float] = None,
+                 byte_rate: Optional[float] = None, byte_burst: Optional[float] = None):
+        self.queries = None if query_rate is None else TokenBucket(query_rate, query_burst or max(1.0, query_rate))
+        self.bytes = None if byte_rate is None else TokenBucket(byte_rate, byte_burst or byte_rate)
+        self.rejected: Dict[str, int] = {QUERIES: 0, BYTES: 0}
+
+    def check(self, size: int, now: Optional[float] = None) -> Optional[str]:
+        """Return why a query of ``size`` bytes must be refused, or ``None``.
+
+        Nothing is consumed; call :meth:`consume` once every limiter
+        involved has allowed the query.
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.queries is not None and self.queries.available(now) < 1:
+            self.rejected[QUERIES] += 1
+            return QUERIES
+        if self.bytes is not None and self.bytes.available(now) < size:
+            self.rejected[BYTES] += 1
+            return BYTES
+        return None
+
+    def consume(self, size: int) -> None:
+        """Charge an accepted query of ``size`` bytes."""
+        if self.queries is not None:
+            self.queries.consume(1)
+        if self.bytes is not None:
+            self.bytes.consume(size)
+
+    def stats(self) -> Dict[str, object]:
+        """Return the remaining tokens and the rejections for monitoring."""
+        return {
+            'query_tokens': None if self.queries is None else round(self.queries.available(), 2),
+            'byte_tokens': None if self.bytes is None else round(self.bytes.available()),
+            'rejected': dict(self.rejected),
+        }
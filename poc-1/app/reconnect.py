@@ -0,0 +1,108 @@
+"""
+reconnect.py
+~~~~~~~~~~~~
+
+Connection state for peers a node keeps reconnecting to: its
+bootstrap peers and outbound peers whose connection dropped.
+
+Failed attempts are retried after an exponentially growing delay with
+random jitter, so that nodes which lost the same peer, for example
+because it restarted, do not all dial it at the same instant.  The
+state also records how long it took to (re)establish the connection.
+"""
+
+from __future__ import annotations
+
+import random
+import time
+from typing import Dict, Optional
+
+from peer_table import Address
+
+IDLE = 'idle'
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+BACKOFF = 'backoff'
+
+
+class DialState:
+    """Reconnect state of a single peer address.
+
+    :param addr: The peer's listening address.
+    :param persistent: Retry forever instead of giving up after
+        ``max_attempts`` consecutive failures.
+    :param base_delay: Delay before the first retry, in seconds.
+    :param max_delay: Upper bound of the retry delay, in seconds.
+    :param max_attempts: Consecutive failures after which a
+        non‑persistent address is given up.
+    """
+
+    def __init__(self, addr: Address, persistent: bool = False, base_delay: float = 1.0,
+                 max_delay: float = 60.0, max_attempts: int = 10):
+        self.addr = addr
+        self.persistent = persistent
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.state = IDLE
+        self.failures = 0
+        self.next_attempt = time.monotonic()
+        # Node address of the peer once connected.
+        self.peer_id: Optional[str] = None
+        # When the peer was last lost (or first wanted) and how long
+        # the most recent (re)connection took.
+        self.down_since = time.monotonic()
+        self.time_to_connect: Optional[float] = None
+        self.connects = 0
+
+    def due(self, now: float) -> bool:
+        """Return ``True`` if a connection attempt should start now."""
+        return self.state in (IDLE, BACKOFF) and now >= self.next_attempt
+
+    def connecting(self) -> None:
+        self.state = CONNECTING
+
+    def connected(self, peer_id: str) -> None:
+        """Record a successful connection to the node ``peer_id``."""
+        now = time.monotonic()
+        self.state = CONNECTED
+        self.peer_id = peer_id
+        self.failures = 0
+        self.time_to_connect = now - self.down_since
+        self.connects += 1
+
+    def failed(self) -> None:
+        """Record a failed attempt and schedule the next one."""
+        self.failures += 1
+        self.state = BACKOFF
+        self.next_attempt = time.monotonic() + self.delay()
+
+    def disconnected(self) -> None:
+        """Record the loss of an established connection."""
+        self.state = BACKOFF
+        self.down_since = time.monotonic()
+        self.next_attempt = self.down_since + self.delay()
+
+    def delay(self) -> float:
+        """Next retry delay: exponential in the failures, with jitter.
+
+        Half of the delay is fixed and half random ("equal jitter"),
+        so retries never happen immediately but are still spread out.
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** self.failures)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def exhausted(self) -> bool:
+        """Return ``True`` if a non‑persistent address should be given up."""
+        return not self.persistent and self.failures >= self.max_attempts
+
+    def stats(self) -> Dict[str, object]:
+        """Return the state for monitoring."""
+        return {
+            'state': self.state,
+            'persistent': self.persistent,
+            'failures': self.failures,
+            'connects': self.connects,
+            'time_to_connect': self.time_to_connect,
+            'retry_in': max(0.0, self.next_attempt - time.monotonic()) if self.state == BACKOFF else None,
+        }
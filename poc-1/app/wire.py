@@ -0,0 +1,385 @@
+"""
+wire.py
+~~~~~~~
+
+Message encodings used on P2P connections.  The handshake defined in
+:mod:`network` is always exchanged as newline terminated JSON so that
+any two nodes can talk to each other regardless of version.  Each
+node lists the codecs it understands in its ``version`` message and
+both sides switch to the negotiated codec once ``verack`` has been
+exchanged.
+
+Three codecs exist:
+
+* ``jsonl`` – the original encoding: one JSON object per line.  It is
+  used for the handshake and for peers that do not advertise any
+  codecs.  ``StreamReader.readline`` refuses lines longer than its
+  64 KiB buffer limit so large messages cannot be carried.
+* ``json`` – JSON objects carried in length‑prefixed frames.
+* ``msgpack`` – MessagePack objects carried in length‑prefixed
+  frames.  This is the preferred codec; it is only advertised when the
+  optional ``msgpack`` package is installed.
+
+A frame is a 4‑byte big endian unsigned length followed by that many
+bytes of encoded payload.  Frames larger than ``MAX_FRAME_SIZE`` are
+rejected and treated like a broken connection.
+
+Framed connections can additionally be compressed.  Nodes list the
+compression schemes they support in their ``version`` message as well
+and the same negotiation picks one.  ``zlib`` is always available;
+``zstd`` is preferred when the optional ``zstandard`` package is
+installed.  Both use a preset dictionary of strings common in this
+protocol's messages, which makes even small frames compress well.
+Only payloads of at least a threshold size are compressed; the top
+bit of the length word marks a compressed frame, and its length is
+that of the compressed bytes.  :class:`CompressingCodec` keeps per
+connection counters of the bytes saved and the CPU time spent.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import struct
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Sequence
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+
+# Upper bound on a single frame.  Large enough for LLM answers and
+# retrieved documents while still protecting against a peer that
+# announces an absurd length.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+_HEADER = struct.Struct('!I')
+
+# Set in the length word of compressed frames.
+COMPRESSED_FLAG = 0x80000000
+
+# Payloads smaller than this are sent uncompressed by default.
+COMPRESS_THRESHOLD = 512
+
+# Preset dictionary shared by all nodes.  Compressors find matches for
+# the start of a message in it; the most common strings go last.
+# Changing it requires a new DICTIONARY_ID, which is part of the scheme
+# names so nodes with different dictionaries never pick each other's.
+DICTIONARY_ID = 1
+DICTIONARY = (
+    b'The information you requested is not available. Please let me know if you have any other questions. '
+    b'Here are some options based on the information provided by the owner: address, opening hours, '
+    b'price, menu, services, products, reviews, contact details, website, phone number, location. '
+    b'I am an agent who represents a business owner, content creator, or any other person. '
+    b'"error":"busy","contacts":[["value":"ok":true,"method":"find_node","rpc_id":"target":"key":'
+    b'"forwarded":"ttl":"origin":"payload":"response":"from":"id":"type":"query","type":"response",'
+    b'\xa5error\xa8contacts\xa5value\xa6method\xa6rpc_id\xa6target\xa3key\xa9forwarded\xa6origin'
+    b'\xa7payload\xa3ttl\xa4from\xa2id\xa8response\xa5query\xa4type'
+)
+
+
+class Codec:
+    """Base class for wire encodings.
+
+    ``encode`` returns the exact bytes to write to the socket and
+    ``read`` returns the next decoded message.  Following the
+    convention used by :mod:`network`, ``read`` returns an empty dict
+    on EOF or when the peer sends something that cannot be decoded.
+    """
+
+    name = ''
+
+    def encode(self, message: Dict[str, object]) -> bytes:
+        raise NotImplementedError
+
+    async def read(self, reader: asyncio.StreamReader) -> Dict[str, object]:
+        raise NotImplementedError
+
+    def stats(self) -> Optional[Dict[str, object]]:
+        """Return per connection counters, if the codec keeps any."""
+        return None
+
+
+class JsonLinesCodec(Codec):
+    """Newline terminated JSON, the original wire format."""
+
+    name = 'jsonl'
+
+    def encode(self, message: Dict[str, object]) -> bytes:
+        return json.dumps(message).encode('utf-8') + b'\n'
+
+    async def read(self, reader: asyncio.StreamReader) -> Dict[str, object]:
+        try:
+            line = await reader.readline()
+        except Exception:
+            return {}
+        if not line:
+            return {}
+        try:
+            return json.loads(line.decode('utf-8'))
+        except Exception:
+            return {}
+
+
+class FramedCodec(Codec):
+    """Length‑prefixed frames around a pluggable payload serializer."""
+
+    def __init__(self, name: str, dumps: Callable[[object], bytes], loads: Callable[[bytes], object]):
+        self.name = name
+        self._dumps = dumps
+        self._loads = loads
+
+    def encode(self, message: Dict[str, object]) -> bytes:
+        payload = self.dumps(message)
+        return _HEADER.pack(len(payload)) + payload
+
+    def dumps(self, message: Dict[str, object]) -> bytes:
+        """Serialise ``message`` into a frame payload."""
+        payload = self._dumps(message)
+        if len(payload) > MAX_FRAME_SIZE:
+            raise ValueError(f"Message of {len(payload)} bytes exceeds maximum frame size")
+        return payload
+
+    def loads(self, payload: bytes) -> Dict[str, object]:
+        """Deserialise a frame payload, returning an empty dict if it is invalid."""
+        try:
+            message = self._loads(payload)
+        except Exception:
+            return {}
+        return message if isinstance(message, dict) else {}
+
+    async def read(self, reader: asyncio.StreamReader) -> Dict[str, object]:
+        try:
+            header = await reader.readexactly(_HEADER.size)
+            (length,) = _HEADER.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                return {}
+            payload = await reader.readexactly(length)
+        except Exception:
+            return {}
+        return self.loads(payload)
+
+
+class Compressor:
+    """A compression scheme using the shared :data:`DICTIONARY`."""
+
+    name = ''
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompress ``data``.
+
+        :raises ValueError: If it is corrupt or would expand beyond
+            :data:`MAX_FRAME_SIZE`.
+        """
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    """DEFLATE with a preset dictionary."""
+
+    name = f'zlib/{DICTIONARY_ID}'
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zdict=DICTIONARY)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        decompressor = zlib.decompressobj(zdict=DICTIONARY)
+        try:
+            result = decompressor.decompress(data, MAX_FRAME_SIZE)
+        except zlib.error as exc:
+            raise ValueError(str(exc)) from exc
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("compressed frame is truncated or too large")
+        return result
+
+
+class ZstdCompressor(Compressor):
+    """Zstandard with a raw content dictionary."""
+
+    name = f'zstd/{DICTIONARY_ID}'
+
+    def __init__(self, level: int = 3):
+        dictionary = zstandard.ZstdCompressionDict(DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        self._compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        self._decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        try:
+            return self._decompressor.decompress(data, max_output_size=MAX_FRAME_SIZE)
+        except zstandard.ZstdError as exc:
+            raise ValueError(str(exc)) from exc
+
+
+class CompressingCodec(Codec):
+    """A framed codec whose large payloads are compressed.
+
+    One instance is created per connection; besides encoding it counts
+    the bytes before and after compression in both directions and the
+    CPU time spent compressing and decompressing.
+
+    :param inner: The negotiated framed codec.
+    :param compressor: The negotiated compression scheme.
+    :param threshold: Smallest payload, in bytes, that is compressed.
+    """
+
+    def __init__(self, inner: FramedCodec, compressor: Compressor, threshold: int = COMPRESS_THRESHOLD):
+        self.name = f'{inner.name}+{compressor.name}'
+        self.inner = inner
+        self.compressor = compressor
+        self.threshold = threshold
+        self.raw_bytes_out = 0
+        self.wire_bytes_out = 0
+        self.raw_bytes_in = 0
+        self.wire_bytes_in = 0
+        self.frames_compressed = 0
+        self.frames_decompressed = 0
+        self.compress_seconds = 0.0
+        self.decompress_seconds = 0.0
+
+    def encode(self, message: Dict[str, object]) -> bytes:
+        payload = self.inner.dumps(message)
+        self.raw_bytes_out += len(payload)
+        if len(payload) >= self.threshold:
+            start = time.process_time()
+            packed = self.compressor.compress(payload)
+            self.compress_seconds += time.process_time() - start
+            # Incompressible payloads are sent as they are.
+            if len(packed) < len(payload):
+                self.frames_compressed += 1
+                self.wire_bytes_out += len(packed)
+                return _HEADER.pack(len(packed) | COMPRESSED_FLAG) + packed
+        self.wire_bytes_out += len(payload)
+        return _HEADER.pack(len(payload)) + payload
+
+    async def read(self, reader: asyncio.StreamReader) -> Dict[str, object]:
+        try:
+            header = await reader.readexactly(_HEADER.size)
+            (length,) = _HEADER.unpack(header)
+            compressed = bool(length & COMPRESSED_FLAG)
+            length &= ~COMPRESSED_FLAG
+            if length > MAX_FRAME_SIZE:
+                return {}
+            payload = await reader.readexactly(length)
+        except Exception:
+            return {}
+        self.wire_bytes_in += len(payload)
+        if compressed:
+            start = time.process_time()
+            try:
+                payload = self.compressor.decompress(payload)
+            except ValueError:
+                return {}
+            finally:
+                self.decompress_seconds += time.process_time() - start
+            self.frames_decompressed += 1
+        self.raw_bytes_in += len(payload)
+        return self.inner.loads(payload)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'scheme': self.compressor.name,
+            'frames_compressed': self.frames_compressed,
+            'frames_decompressed': self.frames_decompressed,
+            'ratio_out': self.raw_bytes_out / self.wire_bytes_out if self.wire_bytes_out else 1.0,
+            'ratio_in': self.raw_bytes_in / self.wire_bytes_in if self.wire_bytes_in else 1.0,
+            'bytes_saved_out': self.raw_bytes_out - self.wire_bytes_out,
+            'compress_cpu_ms': round(self.compress_seconds * 1000, 3),
+            'decompress_cpu_ms': round(self.decompress_seconds * 1000, 3),
+        }
+
+
+JSONL = JsonLinesCodec()
+
+_CODECS: Dict[str, Codec] = {
+    JSONL.name: JSONL,
+    'json': FramedCodec(
+        'json',
+        lambda obj: json.dumps(obj, separators=(',', ':')).encode('utf-8'),
+        lambda data: json.loads(data.decode('utf-8')),
+    ),
+}
+if msgpack is not None:
+    _CODECS['msgpack'] = FramedCodec(
+        'msgpack',
+        lambda obj: msgpack.packb(obj, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+    )
+
+# Codecs in order of preference.  ``jsonl`` is never advertised; it is
+# the implicit fallback for peers that predate codec negotiation.
+_PREFERENCE = ('msgpack', 'json')
+
+
+_COMPRESSORS: Dict[str, Compressor] = {ZlibCompressor.name: ZlibCompressor()}
+if zstandard is not None:
+    _COMPRESSORS[ZstdCompressor.name] = ZstdCompressor()
+
+# Compression schemes in order of preference.
+_COMPRESSION_PREFERENCE = (ZstdCompressor.name, ZlibCompressor.name)
+
+
+def available_codecs() -> List[str]:
+    """Return the names of the codecs this node can speak, best first."""
+    return [name for name in _PREFERENCE if name in _CODECS]
+
+
+def negotiate(initiator: Optional[Sequence[str]], responder: Optional[Sequence[str]]) -> Codec:
+    """Pick the codec for a connection from both sides' advertised lists.
+
+    The first entry of the initiator's list that the responder also
+    supports wins.  Both ends run the same function on the same
+    inputs so they always agree without an extra round trip.  Peers
+    that advertise nothing fall back to ``jsonl``.
+    """
+    if initiator and responder:
+        for name in initiator:
+            if name in responder and name in _CODECS:
+                return _CODECS[name]
+    return JSONL
+
+
+def available_compressors() -> List[str]:
+    """Return the names of the compression schemes this node supports, best first."""
+    return [name for name in _COMPRESSION_PREFERENCE if name in _COMPRESSORS]
+
+
+def negotiate_compression(codec: Codec, initiator: Optional[Sequence[str]], responder: Optional[Sequence[str]],
+                          threshold: int = COMPRESS_THRESHOLD) -> Codec:
+    """Wrap a negotiated codec in compression if both sides support it.
+
+    Uses the same rule as :func:`negotiate`.  Only framed codecs can
+    carry compressed frames; other codecs are returned unchanged.
+    """
+    if not isinstance(codec, FramedCodec) or not initiator or not responder:
+        return codec
+    for name in initiator:
+        if name in responder and name in _COMPRESSORS:
+            return CompressingCodec(codec, _COMPRESSORS[name], threshold)
+    return codec
+
+
+def get_codec(name: str) -> Codec:
+    """Return the codec registered under ``name``.
+
+    :raises KeyError: if the codec is unknown or its optional
+        dependency is not installed.
+    """
+    return _CODECS[name]